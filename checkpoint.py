@@ -0,0 +1,98 @@
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def snapshot(value):
+    # A CPU copy of every tensor, so the training loop can go on while the copy is written.
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [snapshot(item) for item in value]
+    return value
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    # Checkpoints are written to <prefix>_<name> on a background thread and listed with their step and score
+    # in <prefix>_checkpoints.json. After every write only the keep_last latest and the keep_best highest
+    # scored checkpoints are kept; None keeps all of them. The latest checkpoint is always kept.
+    # The checkpoints of an earlier run are only listed when resuming it. A fresh run starts an empty manifest and
+    # leaves the files of the earlier run alone.
+    def __init__(self, prefix, keep_last=None, keep_best=None, resume=False):
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest_path = f'{prefix}_checkpoints.json'
+        self.checkpoints = []
+        if resume and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest:
+                self.checkpoints = json.load(manifest)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, name, state, score=None):
+        # Returns once state is copied. Only one checkpoint is held in memory while waiting to be written.
+        self.wait()
+        self.pending = self.executor.submit(self.write, f'{self.prefix}_{name}', snapshot(state), score)
+
+    def write(self, path, state, score):
+        torch.save(state, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint['path'] != path]
+        self.checkpoints.append({'path': path, 'step': state['step'], 'score': score})
+        self.retain()
+        with open(f'{self.manifest_path}.tmp', 'w') as manifest:
+            json.dump(self.checkpoints, manifest, indent=1)
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+    def retain(self):
+        by_step = sorted(self.checkpoints, key=lambda checkpoint: checkpoint['step'])
+        if self.keep_last is None:
+            keep = by_step
+        else:
+            keep = by_step[::-1][:self.keep_last]
+        scored = [checkpoint for checkpoint in by_step if checkpoint['score'] is not None]
+        if self.keep_best is not None:
+            scored = sorted(scored, key=lambda checkpoint: checkpoint['score'], reverse=True)[:self.keep_best]
+        elif self.keep_last is not None:
+            scored = []
+        paths = {checkpoint['path'] for checkpoint in keep + scored + by_step[-1:]}
+        for checkpoint in by_step:
+            if checkpoint['path'] not in paths and os.path.exists(checkpoint['path']):
+                os.remove(checkpoint['path'])
+        self.checkpoints = [checkpoint for checkpoint in by_step if checkpoint['path'] in paths]
+
+    def latest(self):
+        self.wait()
+        if not self.checkpoints:
+            return None
+        return max(self.checkpoints, key=lambda checkpoint: checkpoint['step'])['path']
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,148 @@
+from collections import namedtuple
+import copy
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from sampler import text_lengths
+
+
+Batch = namedtuple('Batch', ['indices', 'text', 'binary', 'labels', 'inputs'], defaults=[None])
+
+
+class TextDataset:
+    # The texts and label columns are stored once as arrays; views and batches are index arrays into them.
+    # Without a sampler the batches follow the order of the indices, otherwise the sampler decides them per epoch.
+    def __init__(self, text, binary=None, labels=None, batch_size=8, indices=None):
+        self.text = text if isinstance(text, np.ndarray) else np.array(list(text), dtype=object)
+        self.binary = None if binary is None else np.asarray(binary)
+        self.labels = None if labels is None else np.asarray(labels)
+        self.batch_size = batch_size
+        self.indices = np.arange(len(self.text)) if indices is None else np.asarray(indices)
+        self.sampler = None
+        self.lengths = None
+        self.epoch = 0
+        self.tokens = None
+        self.plan = None
+
+    @classmethod
+    def from_frame(cls, df, batch_size=8):
+        return cls(df.text.to_numpy(dtype=object),
+                   binary=df.binary.to_numpy() if 'binary' in df else None,
+                   labels=df.labels.to_numpy() if 'labels' in df else None,
+                   batch_size=batch_size)
+
+    def replace(self, **attributes):
+        dataset = copy.copy(self)
+        dataset.plan = None
+        dataset.__dict__.update(attributes)
+        return dataset
+
+    def view(self, indices):
+        return self.replace(indices=np.asarray(indices))
+
+    def with_binary(self, binary):
+        # binary is indexed like the underlying arrays, not like the current view.
+        return self.replace(binary=np.asarray(binary))
+
+    def with_sampler(self, sampler, lengths=None):
+        # lengths is indexed like the underlying arrays. It defaults to the token counts of the attached
+        # token store, or to the whitespace token count of the texts.
+        if lengths is None and (sampler.bucket_size is not None or sampler.max_tokens is not None):
+            if self.lengths is not None:
+                lengths = self.lengths
+            elif self.tokens is not None:
+                lengths = np.asarray(self.tokens.lengths)
+            else:
+                lengths = text_lengths(self.text)
+        return self.replace(sampler=sampler, lengths=lengths)
+
+    def with_tokens(self, tokens):
+        # tokens is a TokenStore built over the underlying text array; batches then carry the tokenized inputs.
+        return self.replace(tokens=tokens)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def filter(self, mask):
+        return self.view(self.indices[np.asarray(mask, dtype=bool)])
+
+    def split(self, test_size=0.25, random_state=42):
+        train, valid = train_test_split(self.indices, test_size=test_size, random_state=random_state)
+        return self.view(train), self.view(valid)
+
+    def shuffled(self, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        return self.view(rng.permutation(self.indices))
+
+    def size(self):
+        return len(self.indices)
+
+    def column(self, name):
+        values = getattr(self, name)
+        return None if values is None else values[self.indices]
+
+    def texts(self):
+        return self.text[self.indices].tolist()
+
+    def batch_indices(self):
+        # The plan of the sampler is kept for its epoch and seed, views start without one.
+        if self.sampler is not None:
+            if self.plan is None or self.plan[0] != (self.epoch, self.sampler.seed):
+                self.plan = ((self.epoch, self.sampler.seed),
+                             self.sampler.batches(self.indices, self.lengths, self.epoch))
+            return self.plan[1]
+        if self.batch_size == 0:
+            return [self.indices]
+        return [self.indices[i:i + self.batch_size] for i in range(0, len(self.indices), self.batch_size)]
+
+    def get_batch(self, indices):
+        return Batch(indices, self.text[indices].tolist(),
+                     None if self.binary is None else self.binary[indices],
+                     None if self.labels is None else self.labels[indices],
+                     None if self.tokens is None else self.tokens.gather(indices))
+
+    def __len__(self):
+        if self.sampler is not None:
+            return len(self.batch_indices())
+        if self.batch_size == 0:
+            return 1
+        return -(-len(self.indices) // self.batch_size)
+
+    def __iter__(self):
+        for indices in self.batch_indices():
+            yield self.get_batch(indices)
+
+    def to_frame(self):
+        data = {'text': self.column('text')}
+        if self.binary is not None:
+            data['binary'] = self.column('binary')
+        if self.labels is not None:
+            data['labels'] = self.column('labels')
+        return pd.DataFrame(data=data)
+
+
+class MultiLabelDataset(TextDataset):
+    # binary is a label matrix with one column per category; category views share the text and the matrix.
+    def __init__(self, text, binary, categories, batch_size=8, indices=None):
+        super(MultiLabelDataset, self).__init__(text, binary=binary, batch_size=batch_size, indices=indices)
+        self.categories = list(categories)
+
+    def category(self, cat):
+        dataset = TextDataset(self.text, binary=self.binary[:, self.categories.index(cat)],
+                              batch_size=self.batch_size, indices=self.indices)
+        dataset.__dict__.update({name: value for name, value in self.__dict__.items()
+                                 if name not in ['binary', 'categories']})
+        return dataset
+
+    def category_views(self):
+        return {cat: self.category(cat) for cat in self.categories}
+
+
+def frame_to_batch(df, categories=None):
+    # categories names the label columns of a multi-label frame; they are stacked into the binary matrix.
+    if categories is not None:
+        binary = df[categories].to_numpy()
+    else:
+        binary = df.binary.to_numpy() if 'binary' in df else None
+    return Batch(df.index.to_numpy(), df.text.tolist(), binary,
+                 df.labels.to_numpy() if 'labels' in df else None)
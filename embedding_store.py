@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import torch
+from store_cache import build_arrays, length_sorted_chunks, load_arrays, store_key
+
+
+EMBEDDING_CACHE_DIR = '.embedding_cache'
+
+
+def embedding_store_key(texts, model, encoder):
+    # The texts, the tokenization and a fingerprint of the weights of the encoder.
+    return store_key(f'{type(model).__name__}:{model.tokenizer.name_or_path}:{model.max_length}', texts,
+                     encoder.state_dict())
+
+
+class EmbeddingStore:
+    # Pooled outputs of a frozen encoder for a whole dataset, kept in memory-mapped .npy files. Gathered
+    # batches are passed to the models in place of the tokenized texts, so only the heads are run.
+    def __init__(self, pooled_output, lengths):
+        self.pooled_output = pooled_output
+        self.lengths = lengths
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_arrays(path, ['pooled_output', 'lengths']))
+
+    @classmethod
+    def build(cls, texts, model, encoder, cache_dir=EMBEDDING_CACHE_DIR, batch_size=64, device='cpu'):
+        def fill(create):
+            pooled_output = None
+            lengths = create('lengths', np.int32, (len(texts),))
+            for chunk in length_sorted_chunks(model, texts, batch_size):
+                tokenized = model.tokenizer([str(texts[i]) for i in chunk], truncation=True,
+                                            max_length=model.max_length, padding=True, return_tensors='pt')
+                inputs = {'input_ids': tokenized['input_ids'], 'attention_mask': tokenized['attention_mask']}
+                pooled = model.encode(inputs, device=device).float().cpu().numpy()
+                if pooled_output is None:
+                    pooled_output = create('pooled_output', np.float32, (len(texts), pooled.shape[1]))
+                pooled_output[chunk] = pooled
+                lengths[chunk] = tokenized['attention_mask'].sum(dim=1).numpy()
+
+        path = os.path.join(cache_dir, embedding_store_key(texts, model, encoder))
+        return cls(*build_arrays(path, ['pooled_output', 'lengths'], fill))
+
+    def gather(self, indices):
+        return {'pooled_output': torch.from_numpy(np.ascontiguousarray(self.pooled_output[indices]))}
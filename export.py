@@ -0,0 +1,167 @@
+from argparse import ArgumentParser
+import json
+import os
+import time
+import numpy as np
+import torch
+from torch import nn
+from transformers import BertTokenizerFast
+from dataset import TextDataset
+from read_data import load_frame
+from train_model import load_model_file, predict, tokenize
+
+
+class ExportWrapper(nn.Module):
+    # The graph of a classifier without its tokenizer: token ids and attention mask in, logits out.
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model({'input_ids': input_ids, 'attention_mask': attention_mask})[1]
+
+
+def available_cpus():
+    # The CPUs this process may run on, which is fewer than os.cpu_count() in containers and under taskset.
+    # More intra-op threads than that make both runtimes much slower.
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def set_threads(threads=None, interop_threads=None):
+    # Has to be called before the first parallel work of the process.
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def export_model(model, path, export_format='torchscript', labels=None):
+    # Writes the graph to path, the tokenizer to <path>_tokenizer and what the runner needs to know to <path>.json.
+    if not hasattr(model, 'tokenizer'):
+        raise Exception("Only the BERT classifiers can be exported!")
+    model = model.to('cpu').eval()
+    wrapper = ExportWrapper(model).eval()
+    example = model.tokenizer(['an example', 'a second, longer example text'], padding=True, return_tensors='pt')
+    inputs = (example['input_ids'], example['attention_mask'])
+    with torch.no_grad():
+        logits = wrapper(*inputs)
+        if export_format == 'onnx':
+            dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                            'logits': {0: 'batch'}}
+            torch.onnx.export(wrapper, inputs, path, input_names=['input_ids', 'attention_mask'],
+                              output_names=['logits'], dynamic_axes=dynamic_axes)
+        else:
+            torch.jit.freeze(torch.jit.trace(wrapper, inputs, check_trace=False)).save(path)
+    model.tokenizer.save_pretrained(f'{path}_tokenizer')
+    meta = {'format': export_format, 'max_length': model.max_length, 'categories': getattr(model, 'categories', None),
+            'labels': labels if labels is not None else [str(i) for i in range(logits.shape[-1])]}
+    with open(f'{path}.json', 'w') as meta_file:
+        json.dump(meta, meta_file, indent=1)
+
+
+class ExportedModel:
+    # Runs an exported graph like the eager models: called with texts or tokenized inputs, returns (None, logits).
+    # ONNX graphs need onnxruntime, which is only imported for them.
+    def __init__(self, path, threads=None, interop_threads=None):
+        with open(f'{path}.json') as meta_file:
+            self.meta = json.load(meta_file)
+        self.tokenizer = BertTokenizerFast.from_pretrained(f'{path}_tokenizer')
+        self.max_length = self.meta['max_length']
+        if self.meta['format'] == 'onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            if interop_threads is not None:
+                options.inter_op_num_threads = interop_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path)
+
+    def eval(self):
+        return self
+
+    def label_dict(self):
+        if self.meta['categories'] is not None:
+            return {cat: {0: 'OTHER', 1: cat} for cat in self.meta['categories']}
+        return dict(enumerate(self.meta['labels']))
+
+    def __call__(self, text, labels=None, device='cpu'):
+        input_ids, attention_mask = tokenize(self.tokenizer, text, max_length=self.max_length)
+        if self.session is not None:
+            logits = self.session.run(['logits'], {'input_ids': input_ids.numpy(),
+                                                   'attention_mask': attention_mask.numpy()})[0]
+            return None, torch.from_numpy(logits)
+        return None, self.module(input_ids, attention_mask)
+
+
+def read_texts(path, data_type):
+    if data_type == 'twitter':
+        return load_frame(path, ['text', 'binary', 'labels', 'explicit']).text.astype(str).tolist()
+    return load_frame(path, ['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming'],
+                      force_names=True).comment_text.astype(str).tolist()
+
+
+def time_batches(model, texts, batch_size, num_batches):
+    # Seconds per batch, tokenization included, after one warm-up batch.
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    batches = [batches[i % len(batches)] for i in range(num_batches + 1)]
+    timings = []
+    with torch.inference_mode():
+        for batch in batches:
+            start = time.perf_counter()
+            model(batch, device='cpu')
+            timings.append(time.perf_counter() - start)
+    return np.array(timings[1:])
+
+
+def benchmark(model, exported, texts, batch_sizes, num_batches=20):
+    model.eval()
+    print("Batch size\tEager ms\tExported ms\tEager texts/s\tExported texts/s\tSpeedup")
+    for batch_size in batch_sizes:
+        eager = time_batches(model, texts, batch_size, num_batches)
+        graph = time_batches(exported, texts, batch_size, num_batches)
+        size = min(batch_size, len(texts))
+        print(f"{batch_size}\t{round(eager.mean() * 1000, 2)}\t{round(graph.mean() * 1000, 2)}\t"
+              f"{round(size / eager.mean(), 1)}\t{round(size / graph.mean(), 1)}\t"
+              f"{round(eager.mean() / graph.mean(), 2)}x")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--action', choices=['export', 'predict', 'benchmark'], default='export')
+    parser.add_argument('--model_path', help='Checkpoint or pickled model to export or to benchmark against.')
+    parser.add_argument('--export_path', required=True)
+    parser.add_argument('--format', choices=['torchscript', 'onnx'], default='torchscript')
+    parser.add_argument('--labels', nargs='+', default=None,
+                        help='Names of the output classes, used as the header of the predictions.')
+    parser.add_argument('--data_path')
+    parser.add_argument('--data_type', choices=['twitter', 'facebook'], default='twitter')
+    parser.add_argument('--predict_path', default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--benchmark_batches', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Intra-op threads, the number of CPUs available to the process by default.')
+    parser.add_argument('--interop_threads', type=int, default=1,
+                        help='Inter-op threads. A single classifier graph has little to run in parallel.')
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = available_cpus()
+    set_threads(args.threads, args.interop_threads)
+    if args.action == 'export':
+        export_model(load_model_file(args.model_path), args.export_path, export_format=args.format,
+                     labels=args.labels)
+    else:
+        runner = ExportedModel(args.export_path, threads=args.threads, interop_threads=args.interop_threads)
+        texts = read_texts(args.data_path, args.data_type)
+        if args.action == 'predict':
+            predict(runner, TextDataset(texts, batch_size=args.batch_size), runner.label_dict(),
+                    file_path=args.predict_path, batch_size=args.batch_size)
+        else:
+            benchmark(load_model_file(args.model_path), runner, texts, args.batch_sizes, args.benchmark_batches)
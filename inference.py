@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+from dataset import TextDataset
+from sampler import text_lengths
+
+
+def iterate_windows(data, window_size):
+    # Yields (indices, texts) windows in the original order. Indices are None for streamed data.
+    if isinstance(data, TextDataset):
+        for start in range(0, data.size(), window_size):
+            indices = data.indices[start:start + window_size]
+            yield indices, data.text[indices].tolist()
+        return
+    texts = []
+    for batch in data:
+        texts += batch.text
+        while len(texts) >= window_size:
+            yield None, texts[:window_size]
+            texts = texts[window_size:]
+    if texts:
+        yield None, texts
+
+
+def predict_probabilities(model, data, batch_size=64, window_batches=16, device='cpu'):
+    # Texts are read in windows of window_batches batches. Every window is sorted by length, so that the
+    # large batches carry little padding, and its probabilities are put back in the original order.
+    # No labels or loss are needed.
+    tokens = getattr(data, 'tokens', None)
+    softmax = torch.nn.Softmax(dim=-1)
+    model.eval()
+    with torch.inference_mode():
+        for indices, texts in iterate_windows(data, batch_size * window_batches):
+            lengths = np.asarray(tokens.lengths[indices]) if tokens is not None else text_lengths(texts)
+            order = np.argsort(lengths, kind='stable')
+            probs = None
+            for start in range(0, len(order), batch_size):
+                chunk = order[start:start + batch_size]
+                if tokens is not None:
+                    inputs = tokens.gather(indices[chunk])
+                else:
+                    inputs = [texts[i] for i in chunk]
+                chunk_probs = softmax(model(inputs, device=device)[1].float()).cpu().numpy()
+                if probs is None:
+                    probs = np.empty((len(texts),) + chunk_probs.shape[1:], dtype=chunk_probs.dtype)
+                probs[chunk] = chunk_probs
+            yield texts, probs
+
+
+def write_probabilities(out_file, texts, probs):
+    rows = ['\t'.join(row) for row in probs.astype(str)]
+    out_file.write(''.join([f'{text}\t{row}\n' for text, row in zip(texts, rows)]))
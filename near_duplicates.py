@@ -0,0 +1,132 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+PRIME = (1 << 31) - 1
+
+
+BASE = 1000003
+
+
+def mod_prime(x):
+    # x mod PRIME for x < 2 ** 62 without a division: PRIME is the Mersenne prime 2 ** 31 - 1.
+    x = (x & PRIME) + (x >> 31)
+    x = (x & PRIME) + (x >> 31)
+    return np.where(x >= PRIME, x - PRIME, x)
+
+
+def shingle_hashes(texts, ngram=5):
+    # Polynomial hashes mod PRIME of the character n-grams of every text, computed for all texts at once on their
+    # concatenated code points. Texts are lower-cased with whitespace collapsed; texts of at most ngram characters
+    # are padded with NUL to a single n-gram. Returns the hashes and the offset of the first hash of every text.
+    texts = [' '.join(str(text).lower().split()).ljust(ngram, '\0') for text in texts]
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    windows = len(codes) - ngram + 1
+    hashes = np.zeros(windows, dtype=np.uint64)
+    for k in range(ngram):
+        hashes = mod_prime(hashes * BASE + codes[k:k + windows])
+    # Only the windows starting in the first length - ngram + 1 characters of a text lie inside it.
+    counts = lengths - ngram + 1
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    inside = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+    return hashes[inside], offsets
+
+
+def minhash_signatures(texts, num_perm=64, ngram=5, seed=42, chunk_size=256):
+    # Character n-gram MinHash with num_perm multiply-shift hash functions (a * x + b) >> 32 on 64 bits, a odd,
+    # vectorised over chunks of chunk_size texts.
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64) << np.uint64(1) | np.uint64(1)
+    b = rng.randint(0, 1 << 62, size=num_perm, dtype=np.int64).astype(np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for start in range(0, len(texts), chunk_size):
+        hashes, offsets = shingle_hashes(texts[start:start + chunk_size], ngram)
+        permuted = ((a[:, None] * hashes + b[:, None]) >> np.uint64(32)).astype(np.uint32)
+        signatures[start:start + len(offsets)] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def union(parent, i, j):
+    root_i, root_j = find(parent, i), find(parent, j)
+    if root_i != root_j:
+        parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def bucket_components(signatures, members, threshold, chunk_size=256):
+    # Connected components of the members of a bucket, joined by every pair similar on the full signature.
+    # The pairs are compared chunk_size rows against chunk_size rows at a time.
+    rows, cols = [], []
+    for left in range(0, len(members), chunk_size):
+        for right in range(left, len(members), chunk_size):
+            similarity = (signatures[members[left:left + chunk_size], None]
+                          == signatures[None, members[right:right + chunk_size]]).mean(axis=2)
+            i, j = np.nonzero(similarity >= threshold)
+            rows.append(left + i)
+            cols.append(right + j)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(members), len(members)))
+    return connected_components(graph, directed=False)[1]
+
+
+def lsh_groups(signatures, bands=16, threshold=0.8, chunk_size=256):
+    # Rows with identical signatures are joined up front, so a bucket of k identical texts costs nothing. Every
+    # pair of distinct signatures sharing a band is then verified on the full signature, unless the whole bucket
+    # is already one group.
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = list(range(n))
+    keys = np.ascontiguousarray(signatures).view(np.dtype((np.void, signatures.dtype.itemsize * num_perm))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    representative = first[inverse.ravel()]
+    for i in np.flatnonzero(representative != np.arange(n)):
+        union(parent, i, representative[i])
+    distinct = np.sort(first)
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[distinct, band * rows:(band + 1) * rows])
+        band_keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, bucket_of, sizes = np.unique(band_keys, return_inverse=True, return_counts=True)
+        order = np.argsort(bucket_of.ravel(), kind='stable')
+        for bucket in np.split(order, np.cumsum(sizes)[:-1]):
+            if len(bucket) < 2:
+                continue
+            members = distinct[bucket]
+            if len({find(parent, i) for i in members}) == 1:
+                continue
+            components = bucket_components(signatures, members, threshold, chunk_size)
+            _, firsts = np.unique(components, return_index=True)
+            for k, component in enumerate(components):
+                if firsts[component] != k:
+                    union(parent, members[k], members[firsts[component]])
+    return np.array([find(parent, i) for i in range(n)])
+
+
+def near_duplicate_groups(texts, threshold=0.8, num_perm=64, bands=16, ngram=5, seed=42):
+    # Every text gets the index of the first text of its near-duplicate group.
+    texts = list(texts)
+    if len(texts) == 0:
+        return np.zeros(0, dtype=int)
+    return lsh_groups(minhash_signatures(texts, num_perm=num_perm, ngram=ngram, seed=seed), bands=bands,
+                      threshold=threshold)
+
+
+def near_duplicate_mask(texts, **kwargs):
+    # True for every text that is a near-duplicate of an earlier one.
+    groups = near_duplicate_groups(texts, **kwargs)
+    return groups != np.arange(len(groups))
+
+
+def near_duplicates_of(texts, references, **kwargs):
+    # True for every text that falls into the same near-duplicate group as one of the references.
+    texts, references = list(texts), list(references)
+    groups = near_duplicate_groups(texts + references, **kwargs)
+    return np.isin(groups[:len(texts)], groups[len(texts):])
@@ -0,0 +1,19 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(items, prepare, depth=2, workers=1):
+    # Runs prepare on up to depth upcoming items on worker threads while the caller works on the current one.
+    # Results come back in the order of the items.
+    if depth <= 0:
+        for item in items:
+            yield prepare(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(prepare, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,11 +1,24 @@
 from argparse import ArgumentParser
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import Counter, OrderedDict
+from functools import lru_cache, partial
+from itertools import islice
 import pandas as pd
 import numpy as np
 import re
 import emoji
 from cleantext import clean
-from sklearn.model_selection import train_test_split
-from transformers import BertTokenizer
+from sklearn.model_selection import GroupShuffleSplit
+from transformers import BertTokenizer, BertTokenizerFast
+from dataset import MultiLabelDataset, TextDataset, frame_to_batch
+from near_duplicates import near_duplicate_groups, near_duplicate_mask, near_duplicates_of
+
+
+PREPROCESS_CACHE_DIR = '.preprocess_cache'
+PREPROCESS_CACHE_VERSION = 2
 
 
 def demojify(text, language='de'):
@@ -26,6 +39,94 @@ def clean_other(text, language='de', mode='twitter'):
                  lang=language)
 
 
+class LRUMemo:
+    def __init__(self, maxsize=1 << 18):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+    def save(self, path):
+        with open(path, 'w') as memo_file:
+            json.dump([[mode, text, value] for (mode, text), value in self.entries.items()], memo_file)
+
+    def load(self, path):
+        with open(path) as memo_file:
+            for mode, text, value in json.load(memo_file):
+                self.put((mode, text), value)
+
+
+normalization_memo = LRUMemo()
+
+
+@lru_cache(maxsize=1 << 16)
+def cached_demojify(text, language='de'):
+    return demojify(text, language=language)
+
+
+@lru_cache(maxsize=1 << 16)
+def cached_clean_other(text, language='de', mode='twitter'):
+    return clean_other(text, language=language, mode=mode)
+
+
+def normalization_stats():
+    return {'normalize': normalization_memo.stats(),
+            'demojify': cached_demojify.cache_info()._asdict(),
+            'clean_other': cached_clean_other.cache_info()._asdict()}
+
+
+def normalize(text, mode='twitter'):
+    return clean_other(demojify(text), mode=mode)
+
+
+def normalize_chunk(texts, mode='twitter'):
+    return [normalize(text, mode=mode) for text in texts]
+
+
+def normalize_texts(texts, mode='twitter', workers=None, chunk_size=1000, memo=normalization_memo):
+    # Duplicates are normalized once and texts already in the memo are not normalized at all.
+    # The remaining chunks are spread over a process pool; imap keeps them in input order.
+    texts = list(texts)
+    results = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        found, value = memo.get((mode, text)) if memo is not None else (False, None)
+        if found:
+            results[text] = value
+        else:
+            missing.append(text)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(missing) <= chunk_size:
+        normalized = normalize_chunk(missing, mode=mode)
+    else:
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+            normalized = [text for chunk in pool.imap(partial(normalize_chunk, mode=mode), chunks) for text in chunk]
+    for text, value in zip(missing, normalized):
+        results[text] = value
+        if memo is not None:
+            memo.put((mode, text), value)
+    return [results[text] for text in texts]
+
+
 def replace_others(text, text_processor):
     text = text_processor.spell_corrector.correct_text(text)
     text = text.strip().replace('\n', '<nl>')
@@ -61,20 +162,181 @@ def detect_dialect(sample, possible_delimiters=None):
     return has_header, num_cols, delimiter
 
 
-def read_csv(path, names, force_names=False):
+def read_sample(path, max_lines=1000, max_bytes=1 << 20):
+    lines = []
+    size = 0
     with open(path, 'r') as csv_file:
-        string = csv_file.read()
-        has_header, num_cols, delimiter = detect_dialect(string)
+        for line in csv_file:
+            lines.append(line)
+            size += len(line)
+            if (max_lines is not None and len(lines) >= max_lines) or (max_bytes is not None and size >= max_bytes):
+                break
+    return ''.join(lines)
+
+
+def dialect_cache_path(path):
+    return f'{path}.dialect.json'
+
+
+def load_cached_dialect(path):
+    try:
+        with open(dialect_cache_path(path)) as cache_file:
+            cached = json.load(cache_file)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if cached.get('size') != stat.st_size or cached.get('mtime') != stat.st_mtime:
+        return None
+    return cached['has_header'], cached['num_cols'], cached['delimiter']
+
+
+def save_cached_dialect(path, dialect):
+    has_header, num_cols, delimiter = dialect
+    try:
+        stat = os.stat(path)
+        with open(dialect_cache_path(path), 'w') as cache_file:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'has_header': bool(has_header),
+                       'num_cols': num_cols, 'delimiter': delimiter}, cache_file)
+    except OSError:
+        pass
+
+
+def read_csv(path, names, force_names=False, dialect=None, sniff_lines=1000, sniff_bytes=1 << 20, use_cache=True,
+             chunksize=None):
+    # dialect is a (has_header, num_cols, delimiter) tuple as returned by detect_dialect.
+    # Setting both sniff_lines and sniff_bytes to None sniffs the whole file.
+    # Detected dialects are stored next to the file and reused while its size and mtime are unchanged.
+    # With chunksize set, an iterator of DataFrames is returned instead of a single DataFrame.
+    if dialect is None and use_cache:
+        dialect = load_cached_dialect(path)
+    if dialect is None:
+        dialect = detect_dialect(read_sample(path, max_lines=sniff_lines, max_bytes=sniff_bytes))
+        if use_cache:
+            save_cached_dialect(path, dialect)
+    has_header, num_cols, delimiter = dialect
+    cols = names if num_cols is None else names[:num_cols]
     quoting = 3 if delimiter not in ',.:;' else 0
     doublequote = quoting == 0
     if has_header and not force_names:
-        return pd.read_csv(path, sep=delimiter, quoting=quoting, doublequote=doublequote)
+        return pd.read_csv(path, sep=delimiter, quoting=quoting, doublequote=doublequote, chunksize=chunksize)
     elif has_header:
-        return pd.read_csv(path, sep=delimiter, header=0, names=names[:num_cols], quoting=quoting,
-                           doublequote=doublequote)
+        return pd.read_csv(path, sep=delimiter, header=0, names=cols, quoting=quoting,
+                           doublequote=doublequote, chunksize=chunksize)
     else:
-        return pd.read_csv(path, sep=delimiter, header=None, names=names[:num_cols], quoting=quoting,
-                           doublequote=doublequote)
+        return pd.read_csv(path, sep=delimiter, header=None, names=cols, quoting=quoting,
+                           doublequote=doublequote, chunksize=chunksize)
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_cache_path(path):
+    return f'{path}.hash.json'
+
+
+def cached_file_hash(path):
+    # The hash is stored next to the file and reused while its size and mtime are unchanged.
+    stat = os.stat(path)
+    try:
+        with open(hash_cache_path(path)) as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('size') == stat.st_size and cached.get('mtime') == stat.st_mtime:
+            return cached['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = file_hash(path)
+    try:
+        with open(hash_cache_path(path), 'w') as cache_file:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': digest}, cache_file)
+    except OSError:
+        pass
+    return digest
+
+
+def columnar_kind(values):
+    # num for numeric and bool columns, str for columns of strings and nulls, None for anything else.
+    if values.to_numpy().dtype.kind in 'biuf':
+        return 'num'
+    if values.dropna().map(lambda value: isinstance(value, str)).all():
+        return 'str'
+    return None
+
+
+def save_columnar(df, path):
+    # Numeric and bool columns are stored as plain arrays, string columns as utf-8 bytes plus offsets and a null
+    # mask. Returns False without writing anything when a column is neither, since it would not load back the same.
+    kinds = [columnar_kind(df[column]) for column in df.columns]
+    if None in kinds:
+        return False
+    arrays = {'columns': np.array([str(c) for c in df.columns]), 'kinds': np.array(kinds, dtype='<U3')}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if kinds[i] == 'num':
+            arrays[f'{i}_values'] = values.to_numpy()
+        else:
+            nulls = values.isna().to_numpy()
+            encoded = [b'' if null else str(value).encode('utf-8') for value, null in zip(values, nulls)]
+            arrays[f'{i}_data'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            arrays[f'{i}_offsets'] = np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64)
+            arrays[f'{i}_nulls'] = nulls
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as columnar_file:
+        np.savez(columnar_file, **arrays)
+    os.replace(tmp_path, path)
+    return True
+
+
+def load_columnar(path):
+    data = {}
+    with np.load(path) as arrays:
+        for i, (column, kind) in enumerate(zip(arrays['columns'], arrays['kinds'])):
+            if kind == 'num':
+                data[str(column)] = arrays[f'{i}_values']
+            else:
+                raw = arrays[f'{i}_data'].tobytes()
+                offsets = arrays[f'{i}_offsets'].tolist()
+                nulls = arrays[f'{i}_nulls']
+                data[str(column)] = [None if null else raw[start:end].decode('utf-8')
+                                     for start, end, null in zip(offsets[:-1], offsets[1:], nulls)]
+    return pd.DataFrame(data=data)
+
+
+def text_column(df):
+    text = 'text' if 'text' in df else 'comment_text'
+    if text not in df:
+        text = 'c_text'
+    return text
+
+
+def preprocess_frame(path, mode='twitter', names=None, force_names=False, cache_dir=PREPROCESS_CACHE_DIR,
+                     use_cache=True, workers=None, chunk_size=1000):
+    # The cache key covers the file content, the cleaning mode and the parsing options,
+    # so editing the source or changing the options invalidates the entry automatically.
+    # Frames with columns save_columnar cannot store are not cached.
+    if names is None:
+        names = ['text', 'binary', 'labels', 'explicit']
+    key = f'{cached_file_hash(path)}:{mode}:{names}:{force_names}:{PREPROCESS_CACHE_VERSION}'
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+    if use_cache and os.path.exists(cache_path):
+        return load_columnar(cache_path)
+    df = read_csv(path, names=names, force_names=force_names)
+    text = text_column(df)
+    df[text] = normalize_texts(df[text], mode=mode, workers=workers, chunk_size=chunk_size)
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_columnar(df, cache_path)
+    return df
+
+
+def load_frame(path, names, force_names=False, preprocess=None):
+    if preprocess is None:
+        return read_csv(path, names=names, force_names=force_names)
+    return preprocess_frame(path, mode=preprocess, names=names, force_names=force_names)
 
 
 def batch(df, batch_size):
@@ -83,64 +345,108 @@ def batch(df, batch_size):
     return [df.iloc[i:i + batch_size] for i in range(0, len(df), batch_size)]
 
 
-def handle_data(path, batch_size, label_dict, binary_label_dict):
-    df = read_csv(path, names=['text', 'binary', 'labels', 'explicit'])
+def handle_data(path, batch_size, label_dict, binary_label_dict, preprocess=None):
+    df = load_frame(path, ['text', 'binary', 'labels', 'explicit'], preprocess=preprocess)
     df.labels = df.labels.replace(label_dict)
     df.binary = df.binary.replace(binary_label_dict)
-    return batch(df, batch_size)
-
-
-def handle_bin_data(path, batch_size, need_other, all_data=False):
-    distinct_datasets = {'ABUSE': None, 'INSULT': None, 'PROFANITY': None}
-    distinct_data = {'ABUSE': [], 'INSULT': [], 'PROFANITY': []}
-    df = read_csv(path, names=['text', 'binary', 'labels', 'explicit'])
-    for cat in distinct_datasets:
+    return TextDataset.from_frame(df, batch_size)
+
+
+def group_indices(values):
+    # Row indices of every distinct value, computed with a single stable sort.
+    codes, uniques = pd.factorize(values)
+    present = np.flatnonzero(codes >= 0)
+    order = present[np.argsort(codes[present], kind='stable')]
+    bounds = np.cumsum(np.bincount(codes[present], minlength=len(uniques)))[:-1]
+    return dict(zip(uniques, np.split(order, bounds)))
+
+
+def handle_bin_data(path, batch_size, need_other, all_data=False, preprocess=None, seed=None):
+    categories = ['ABUSE', 'INSULT', 'PROFANITY']
+    distinct_data = {}
+    df = load_frame(path, ['text', 'binary', 'labels', 'explicit'], preprocess=preprocess)
+    labels = df.labels.to_numpy()
+    data = TextDataset(df.text.to_numpy(dtype=object), labels=labels, batch_size=batch_size)
+    groups = group_indices(labels)
+    empty = np.zeros(0, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    for cat in categories:
+        binary = (labels == cat).astype(np.int8)
         if not all_data:
-            distinct_datasets[cat] = df[df.labels == cat]
-            other = int(len(distinct_datasets[cat]) / 3) if need_other else int(len(distinct_datasets[cat]) / 2)
-            if need_other:
-                distinct_datasets[cat] = distinct_datasets[cat].append(df[df.labels == 'OTHER'].sample(other))
-            for other_cat in distinct_datasets:
-                if other_cat == cat:
-                    continue
-                if len(df[df.labels == other_cat]) >= other:
-                    distinct_datasets[cat] = distinct_datasets[cat].append(df[df.labels == other_cat].sample(other))
-                else:
-                    distinct_datasets[cat] = distinct_datasets[cat].append(df[df.labels == other_cat])
-            distinct_datasets[cat].reset_index(inplace=True, drop=True)
-            distinct_datasets[cat].binary = pd.Series([(cat == lab) * 1 for lab in distinct_datasets[cat].labels])
-            distinct_datasets[cat] = distinct_datasets[cat].sample(frac=1)
+            own = groups.get(cat, empty)
+            other = int(len(own) / 3) if need_other else int(len(own) / 2)
+            parts = [own]
+            for other_cat in (['OTHER'] if need_other else []) + [c for c in categories if c != cat]:
+                members = groups.get(other_cat, empty)
+                parts.append(members if len(members) < other else rng.choice(members, other, replace=False))
+            indices = rng.permutation(np.concatenate(parts))
+        elif need_other:
+            indices = np.arange(len(labels))
         else:
-            if need_other:
-                distinct_datasets[cat] = df
-            else:
-                distinct_datasets[cat] = df[df.binary != "OTHER"].reset_index(drop=True)
-            distinct_datasets[cat].binary = pd.Series([(cat == lab) * 1 for lab in distinct_datasets[cat].labels])
-        distinct_data[cat] = batch(distinct_datasets[cat], batch_size)
+            indices = np.flatnonzero(df.binary.to_numpy() != 'OTHER')
+        distinct_data[cat] = data.view(indices).with_binary(binary)
 
     return distinct_data
 
 
-def read_bin_data(path, batch_size, need_other=False, all_data=False):
+def bin_multi_label_data(path, batch_size, need_other, preprocess=None):
+    # All three tasks on the same rows, with one label column per category.
+    categories = ['ABUSE', 'INSULT', 'PROFANITY']
+    df = load_frame(path, ['text', 'binary', 'labels', 'explicit'], preprocess=preprocess)
+    labels = df.labels.to_numpy()
+    matrix = (labels[:, None] == np.array(categories, dtype=object)).astype(np.int8)
+    data = MultiLabelDataset(df.text.to_numpy(dtype=object), matrix, categories, batch_size=batch_size)
+    if need_other:
+        return data
+    return data.view(np.flatnonzero(df.binary.to_numpy() != 'OTHER'))
+
+
+def read_bin_data(path, batch_size, need_other=False, all_data=False, preprocess=None, seed=None,
+                  multi_label=False, near_duplicate_threshold=None):
+    # With multi_label the data of all categories is returned as one MultiLabelDataset, which always
+    # holds all the data (see all_data).
+    mode = 'twitter' if preprocess is None else preprocess
+    if multi_label:
+        if isinstance(path, str):
+            return split_data(bin_multi_label_data(path, batch_size, need_other, preprocess=preprocess),
+                              near_duplicate_threshold, mode=mode)
+        return (bin_multi_label_data(path[0], batch_size, need_other, preprocess=preprocess),
+                bin_multi_label_data(path[1], batch_size, need_other, preprocess=preprocess))
     if isinstance(path, str):
         train_path = path
         valid_path = None
     else:
         train_path = path[0]
         valid_path = path[1]
-    data_lists = handle_bin_data(train_path, batch_size, need_other, all_data=all_data)
+    data_lists = handle_bin_data(train_path, batch_size, need_other, all_data=all_data, preprocess=preprocess,
+                                 seed=seed)
     if valid_path is not None:
         train = data_lists
-        valid = handle_bin_data(valid_path, batch_size, need_other, all_data=True)
+        valid = handle_bin_data(valid_path, batch_size, need_other, all_data=True, preprocess=preprocess, seed=seed)
     else:
         train = {'ABUSE': None, 'INSULT': None, 'PROFANITY': None}
         valid = {'ABUSE': None, 'INSULT': None, 'PROFANITY': None}
         for cat in train:
-            train[cat], valid[cat] = train_test_split(data_lists[cat], test_size=0.25, random_state=42)
+            train[cat], valid[cat] = split_data(data_lists[cat], near_duplicate_threshold, mode=mode)
     return train, valid
 
 
-def read_data(path, batch_size=8, drop_other=False):
+def near_duplicate_split(data, test_size=0.25, random_state=42, threshold=0.8, mode='twitter'):
+    # Near-duplicates always land on the same side of the split, so they cannot leak into validation.
+    groups = near_duplicate_groups(normalize_texts(data.texts(), mode=mode), threshold=threshold)
+    splitter = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=random_state)
+    train_index, valid_index = next(splitter.split(data.indices, groups=groups))
+    return data.view(data.indices[train_index]), data.view(data.indices[valid_index])
+
+
+def split_data(data, near_duplicate_threshold=None, mode='twitter'):
+    # The train/valid split of a single data file, keeping near-duplicates together when a threshold is given.
+    if near_duplicate_threshold is None:
+        return data.split(test_size=0.25, random_state=42)
+    return near_duplicate_split(data, threshold=near_duplicate_threshold, mode=mode)
+
+
+def read_data(path, batch_size=8, drop_other=False, preprocess=None, near_duplicate_threshold=None):
     if isinstance(path, str):
         train_path = path
         valid_path = None
@@ -152,90 +458,169 @@ def read_data(path, batch_size=8, drop_other=False):
     else:
         label_dict = {'OTHER': 0, 'ABUSE': 1, 'INSULT': 2, 'PROFANITY': 3}
     binary_label_dict = {'OTHER': 0, 'OFFENSE': 1}
-    data_list = handle_data(train_path, batch_size, label_dict, binary_label_dict)
+    data = handle_data(train_path, batch_size, label_dict, binary_label_dict, preprocess=preprocess)
     if valid_path is not None:
-        train = data_list
-        valid = handle_data(valid_path, batch_size, label_dict, binary_label_dict)
+        train = data
+        valid = handle_data(valid_path, batch_size, label_dict, binary_label_dict, preprocess=preprocess)
     else:
-        train, valid = train_test_split(data_list, test_size=0.25, random_state=42)
+        train, valid = split_data(data, near_duplicate_threshold, mode='twitter' if preprocess is None else preprocess)
 
     if drop_other:
-        train_df = pd.concat(train)
-        train_df = train_df[train_df.binary == 1]
-        valid_df = pd.concat(valid)
-        valid_df = valid_df[valid_df.binary == 1]
-        train, valid = batch(train_df, batch_size), batch(valid_df, batch_size)
+        train = train.filter(train.column('binary') == 1)
+        valid = valid.filter(valid.column('binary') == 1)
 
     return train, valid, label_dict, binary_label_dict
 
 
-def read_toxic(path, batch_size=8, split=True):
+def toxic_dataset(df, batch_size):
+    columns = ['Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming']
+    if all(column in df for column in columns):
+        matrix = df[columns].to_numpy(dtype=np.int64)
+    else:
+        matrix = np.zeros((len(df), len(columns)), dtype=np.int64)
+    return MultiLabelDataset(df.comment_text.to_numpy(dtype=object), matrix, ['TOXIC', 'ENGAGING', 'FACT'],
+                             batch_size=batch_size)
+
+
+def read_toxic(path, batch_size=8, split=True, preprocess=None, multi_label=False, near_duplicate_threshold=None):
+    # The three tasks share one text array and label matrix. Unless multi_label is set,
+    # they are returned as a dict of per-category views.
     if isinstance(path, str):
         train_path = path
         valid_path = None
     else:
         train_path = path[0]
         valid_path = path[1]
-    train_df = read_csv(train_path,
-                        names=['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming'],
-                        force_names=True)
-    if 'Sub1_Toxic' not in train_df:
-        train = {'TOXIC': batch(pd.DataFrame(data={'text': train_df.comment_text,
-                                                   'binary': pd.Series([0 for _ in range(len(train_df.comment_text))])}),
-                                batch_size),
-                 'ENGAGING': batch(pd.DataFrame(data={'text': train_df.comment_text,
-                                                      'binary': pd.Series([0 for _ in range(len(train_df.comment_text))])}),
-                                   batch_size),
-                 'FACT': batch(pd.DataFrame(data={'text': train_df.comment_text,
-                                                  'binary': pd.Series([0 for _ in range(len(train_df.comment_text))])}),
-                               batch_size)}
-    else:
-        train = {'TOXIC': batch(pd.DataFrame(data={'text': train_df.comment_text, 'binary': train_df.Sub1_Toxic}),
-                                batch_size),
-                 'ENGAGING': batch(pd.DataFrame(data={'text': train_df.comment_text, 'binary': train_df.Sub2_Engaging}),
-                                   batch_size),
-                 'FACT': batch(pd.DataFrame(data={'text': train_df.comment_text, 'binary': train_df.Sub3_FactClaiming}),
-                               batch_size)}
+    train = toxic_dataset(load_frame(train_path,
+                                     ['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming'],
+                                     force_names=True, preprocess=preprocess), batch_size)
     if valid_path is None and split:
-        valid = {}
-        for cat in train:
-            train[cat], valid[cat] = train_test_split(train[cat], test_size=0.25, random_state=42)
+        train, valid = split_data(train, near_duplicate_threshold,
+                                  mode='facebook' if preprocess is None else preprocess)
     elif valid_path is not None:
-        valid_df = read_csv(valid_path,
-                            names=['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming'],
-                            force_names=True)
-        if 'Sub1_Toxic' not in valid_df:
-            valid = {'TOXIC': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                       'binary': pd.Series([0 for _ in range(len(valid_df.comment_text))])}),
-                                    batch_size),
-                     'ENGAGING': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                          'binary': pd.Series([0 for _ in range(len(valid_df.comment_text))])}),
-                                       batch_size),
-                     'FACT': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                      'binary': pd.Series([0 for _ in range(len(valid_df.comment_text))])}),
-                                   batch_size)}
-        else:
-            valid = {'TOXIC': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                       'binary': valid_df.Sub1_Toxic}),
-                                    batch_size),
-                     'ENGAGING': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                          'binary': valid_df.Sub2_Engaging}),
-                                       batch_size),
-                     'FACT': batch(pd.DataFrame(data={'text': valid_df.comment_text,
-                                                      'binary': valid_df.Sub3_FactClaiming}),
-                                   batch_size)}
+        valid = toxic_dataset(load_frame(valid_path,
+                                         ['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging',
+                                          'Sub3_FactClaiming'],
+                                         force_names=True, preprocess=preprocess), batch_size)
     else:
-        return train, None
-    return train, valid
+        valid = None
+    if multi_label:
+        return train, valid
+    return train.category_views(), None if valid is None else valid.category_views()
+
+
+def stream_batches(chunks, batch_size):
+    # Rows left over at the end of a chunk are carried into the next one, so only the last batch can be short.
+    rest = None
+    for chunk in chunks:
+        if batch_size == 0:
+            yield chunk
+            continue
+        if rest is not None and len(rest) > 0:
+            chunk = pd.concat([rest, chunk])
+        full = len(chunk) - len(chunk) % batch_size
+        for i in range(0, full, batch_size):
+            yield chunk.iloc[i:i + batch_size]
+        rest = chunk.iloc[full:]
+    if rest is not None and len(rest) > 0:
+        yield rest
+
+
+def preprocess_chunk(df, mode='twitter'):
+    text = text_column(df)
+    return df.assign(**{text: normalize_texts(df[text], mode=mode)})
+
+
+class StreamedData:
+    # Re-iterable stand-in for a list of batches: every iteration reads the file again chunk by chunk.
+    # With categories, the label columns of these names are stacked into the binary matrix of the batches.
+    # With preprocess, the texts of every chunk are cleaned with that mode before the transform.
+    def __init__(self, path, names, batch_size, chunk_size, transform=None, force_names=False, categories=None,
+                 preprocess=None):
+        self.path = path
+        self.names = names
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.transform = transform
+        self.force_names = force_names
+        self.categories = categories
+        self.preprocess = preprocess
+
+    def __iter__(self):
+        chunks = read_csv(self.path, self.names, force_names=self.force_names, chunksize=self.chunk_size)
+        if self.preprocess is not None:
+            chunks = map(partial(preprocess_chunk, mode=self.preprocess), chunks)
+        if self.transform is not None:
+            chunks = map(self.transform, chunks)
+        return map(partial(frame_to_batch, categories=self.categories), stream_batches(chunks, self.batch_size))
+
+
+def stream_data(path, batch_size=8, chunk_size=10000, drop_other=False, preprocess=None):
+    if drop_other:
+        label_dict = {'ABUSE': 0, 'INSULT': 1, 'PROFANITY': 2}
+    else:
+        label_dict = {'OTHER': 0, 'ABUSE': 1, 'INSULT': 2, 'PROFANITY': 3}
+    binary_label_dict = {'OTHER': 0, 'OFFENSE': 1}
+
+    def transform(df):
+        if drop_other:
+            df = df[df.binary == 'OFFENSE']
+        df = df.assign(labels=df.labels.replace(label_dict), binary=df.binary.replace(binary_label_dict))
+        return df
 
+    data = StreamedData(path, ['text', 'binary', 'labels', 'explicit'], batch_size, chunk_size, transform,
+                        preprocess=preprocess)
+    return data, label_dict, binary_label_dict
 
-def shuffle(df_list):
-    df = pd.concat(df_list)
-    df = df.sample(frac=1).reset_index(drop=True)
-    data_list = []
-    for i in range(0, len(df) - 7, 8):
-        data_list.append(df.iloc[i:i + 8])
-    return data_list
+
+def stream_bin_data(path, batch_size=8, chunk_size=10000, need_other=False, multi_label=False, preprocess=None):
+    categories = ['ABUSE', 'INSULT', 'PROFANITY']
+
+    def category_transform(cat):
+        def transform(df):
+            if not need_other:
+                df = df[df.binary != 'OTHER']
+            return df.assign(binary=(df.labels == cat).astype(int))
+        return transform
+
+    def multi_label_transform(df):
+        if not need_other:
+            df = df[df.binary != 'OTHER']
+        return df.assign(**{cat: (df.labels == cat).astype(int) for cat in categories})
+
+    names = ['text', 'binary', 'labels', 'explicit']
+    if multi_label:
+        return StreamedData(path, names, batch_size, chunk_size, multi_label_transform, categories=categories,
+                            preprocess=preprocess)
+    return {cat: StreamedData(path, names, batch_size, chunk_size, category_transform(cat), preprocess=preprocess)
+            for cat in categories}
+
+
+def stream_toxic(path, batch_size=8, chunk_size=10000, multi_label=False, preprocess=None):
+    def category_transform(column):
+        def transform(df):
+            binary = df[column] if column in df else pd.Series(0, index=df.index)
+            return pd.DataFrame(data={'text': df.comment_text, 'binary': binary})
+        return transform
+
+    def multi_label_transform(df):
+        data = {'text': df.comment_text}
+        for cat, column in columns.items():
+            data[cat] = df[column] if column in df else pd.Series(0, index=df.index)
+        return pd.DataFrame(data=data)
+
+    columns = {'TOXIC': 'Sub1_Toxic', 'ENGAGING': 'Sub2_Engaging', 'FACT': 'Sub3_FactClaiming'}
+    names = ['comment_id', 'comment_text', 'Sub1_Toxic', 'Sub2_Engaging', 'Sub3_FactClaiming']
+    if multi_label:
+        return StreamedData(path, names, batch_size, chunk_size, multi_label_transform, force_names=True,
+                            categories=list(columns), preprocess=preprocess)
+    return {cat: StreamedData(path, names, batch_size, chunk_size, category_transform(column), force_names=True,
+                              preprocess=preprocess)
+            for cat, column in columns.items()}
+
+
+def shuffle(data, rng=None):
+    return data.shuffled(rng)
 
 
 def save_normalized(path, list_of_lines):
@@ -244,19 +629,59 @@ def save_normalized(path, list_of_lines):
 
 
 def check_vocab(vocab_file, checker_file):
-    words_outside = {}
     with open(vocab_file) as vocab:
-        with open(checker_file) as checker:
-            vocabulary = vocab.read().strip().split('\n')
-            for line in checker:
-                tokens = line.split()
-                for token in tokens:
-                    if token not in vocabulary:
-                        if token not in words_outside:
-                            words_outside[token] = 1
-                        else:
-                            words_outside[token] += 1
-    return words_outside
+        vocabulary = set(vocab.read().strip().split('\n'))
+    words_outside = Counter()
+    with open(checker_file) as checker:
+        for line in checker:
+            words_outside.update(token for token in line.split() if token not in vocabulary)
+    return dict(words_outside)
+
+
+def vocabulary_report(checker_file, pretrained, batch_size=10000, length_bins=(0, 16, 32, 64, 128, 256, 512)):
+    # Whole words are looked up in the tokenizer vocabulary, lines are tokenized in batches by the fast tokenizer.
+    tokenizer = BertTokenizerFast.from_pretrained(pretrained)
+    vocabulary = set(tokenizer.get_vocab())
+    words_outside = Counter()
+    num_words = 0
+    num_unk = 0
+    lengths = []
+    with open(checker_file) as checker:
+        while True:
+            lines = [line.strip() for line in islice(checker, batch_size)]
+            if not lines:
+                break
+            encoded = tokenizer(lines, add_special_tokens=False, return_attention_mask=False,
+                                return_token_type_ids=False)['input_ids']
+            for line, ids in zip(lines, encoded):
+                words = line.split()
+                num_words += len(words)
+                words_outside.update(word for word in words if word not in vocabulary)
+                num_unk += ids.count(tokenizer.unk_token_id)
+                lengths.append(len(ids))
+    lengths = np.array(lengths, dtype=np.int64)
+    counts, edges = np.histogram(lengths, bins=list(length_bins) + [max(length_bins[-1], lengths.max(initial=0)) + 1])
+    return {'lines': len(lengths),
+            'words': num_words,
+            'tokens': int(lengths.sum()),
+            'oov_words': sum(words_outside.values()),
+            'distinct_oov_words': len(words_outside),
+            'unk_tokens': num_unk,
+            'fragmentation': lengths.sum() / num_words if num_words else 0,
+            'length_histogram': list(zip(edges[:-1].tolist(), edges[1:].tolist(), counts.tolist())),
+            'most_common_oov': words_outside.most_common(20)}
+
+
+def print_vocabulary_report(report):
+    print(f"lines: {report['lines']}\twords: {report['words']}\ttokens: {report['tokens']}")
+    print(f"OOV words: {report['oov_words']} ({report['distinct_oov_words']} distinct)\t"
+          f"[UNK] tokens: {report['unk_tokens']}\tsubwords per word: {round(report['fragmentation'], 3)}")
+    print("Token length\tLines")
+    for start, end, count in report['length_histogram']:
+        print(f"{start}-{end - 1}\t{count}")
+    print("Most common OOV words")
+    for word, count in report['most_common_oov']:
+        print(f"{word}\t{count}")
 
 
 def find_important(checker_file, pretrained):
@@ -267,26 +692,45 @@ def find_important(checker_file, pretrained):
             print(tokens)
 
 
-def run_preprocessing(paths, output_paths, mode='twitter'):
+def run_preprocessing(paths, output_paths, mode='twitter', cache_dir=PREPROCESS_CACHE_DIR, use_cache=True,
+                      workers=None, chunk_size=1000, memo_path=None, memo_stats=False):
+    if memo_path is not None and os.path.exists(memo_path):
+        normalization_memo.load(memo_path)
     for path, out in zip(paths, output_paths):
-        df = read_csv(path, names=['text', 'binary', 'labels', 'explicit'])
-        texts = []
-        text = 'text' if 'text' in df else 'comment_text'
-        if text not in df:
-            text = 'c_text'
-        for line in df[text]:
-            texts.append(clean_other(demojify(line), mode=mode))
-        df[text] = texts
+        df = preprocess_frame(path, mode=mode, cache_dir=cache_dir, use_cache=use_cache, workers=workers,
+                              chunk_size=chunk_size)
         df.to_csv(out, sep='\t', index=False)
-
-
-def concat_for_train(paths, result, without):
-    df = pd.concat([read_csv(path, ['text', 'binary', 'labels', 'explicit']) for path in paths])
+    if memo_path is not None:
+        normalization_memo.save(memo_path)
+    if memo_stats:
+        print(normalization_memo.stats())
+
+
+def concat_for_train(paths, result, without, drop_duplicates=False, match_mode=None, near_duplicate_threshold=None):
+    # Rows are matched on their text, or on the normalized text if match_mode is given,
+    # with a single hash-based pass for both the anti-join and the duplicate removal.
+    # Near-duplicates are always searched on normalized text.
+    df = pd.concat([read_csv(path, ['text', 'binary', 'labels', 'explicit']) for path in paths], ignore_index=True)
+    if match_mode is None:
+        key = df.text
+    else:
+        key = pd.Series(normalize_texts(df.text, mode=match_mode), index=df.index)
+    keep = pd.Series(True, index=df.index)
     if without is not None:
         df_negate = read_csv(without, ['text', 'binary', 'labels', 'explicit'])
-        for text in df_negate.text:
-            df = df[df.text != text]
-    df.to_csv(result, sep='\t', index=False)
+        negate = df_negate.text if match_mode is None else normalize_texts(df_negate.text, mode=match_mode)
+        keep &= ~key.isin(set(negate))
+    if drop_duplicates:
+        keep &= ~key.duplicated()
+    if near_duplicate_threshold is not None:
+        mode = 'twitter' if match_mode is None else match_mode
+        normalized = normalize_texts(df.text, mode=mode)
+        if without is not None:
+            keep &= ~near_duplicates_of(normalized, normalize_texts(df_negate.text, mode=mode),
+                                        threshold=near_duplicate_threshold)
+        if drop_duplicates:
+            keep &= ~near_duplicate_mask(normalized, threshold=near_duplicate_threshold)
+    df[keep].to_csv(result, sep='\t', index=False)
 
 
 if __name__ == '__main__':
@@ -296,8 +740,34 @@ if __name__ == '__main__':
     argparser.add_argument('--mode', choices=['facebook', 'twitter'], default='twitter')
     argparser.add_argument('--concat')
     argparser.add_argument('--without')
+    argparser.add_argument('--cache_dir', default=PREPROCESS_CACHE_DIR)
+    argparser.add_argument('--no_cache', action='store_true')
+    argparser.add_argument('--workers', type=int, default=None,
+                           help='Number of normalization processes. Defaults to the number of cores.')
+    argparser.add_argument('--chunk_size', type=int, default=1000,
+                           help='Number of texts handed to a normalization process at once.')
+    argparser.add_argument('--memo_path', default=None,
+                           help='File to keep the normalization memo in between runs.')
+    argparser.add_argument('--memo_stats', action='store_true',
+                           help='Print the hits and misses of the normalization memo after normalizing.')
+    argparser.add_argument('--drop_duplicates', action='store_true',
+                           help='Keep only the first occurrence of each text when concatenating.')
+    argparser.add_argument('--match_normalized', action='store_true',
+                           help='Compare texts after normalizing them with --mode when concatenating.')
+    argparser.add_argument('--near_duplicate_threshold', type=float, default=None,
+                           help='Also treat texts with at least this estimated Jaccard similarity as duplicates '
+                                'when concatenating.')
+    argparser.add_argument('--vocab_report', default=None,
+                           help='Print a vocabulary coverage report of this file for --bert_model.')
+    argparser.add_argument('--bert_model', default='bert-base-german-cased')
     args = argparser.parse_args()
-    if args.concat is None:
-        run_preprocessing(args.to_normalize, args.normalized_path, args.mode)
+    if args.vocab_report is not None:
+        print_vocabulary_report(vocabulary_report(args.vocab_report, args.bert_model))
+    elif args.concat is None:
+        run_preprocessing(args.to_normalize, args.normalized_path, args.mode, cache_dir=args.cache_dir,
+                          use_cache=not args.no_cache, workers=args.workers, chunk_size=args.chunk_size,
+                          memo_path=args.memo_path, memo_stats=args.memo_stats)
     else:
-        concat_for_train(args.normalized_path, args.concat, args.without)
+        concat_for_train(args.normalized_path, args.concat, args.without, drop_duplicates=args.drop_duplicates,
+                         match_mode=args.mode if args.match_normalized else None,
+                         near_duplicate_threshold=args.near_duplicate_threshold)
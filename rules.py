@@ -1,6 +1,5 @@
-import pandas as pd
 import sys
-from read_data import read_toxic, demojify, clean_other
+from read_data import read_toxic, cached_demojify, cached_clean_other
 
 
 def is_dotdot(text):
@@ -14,7 +13,7 @@ def is_caps(text):
     text = text.replace('@USER', '')
     text = text.replace('@MEDIUM', '')
     text = text.replace('@MODERATOR', '')
-    text = demojify(text)
+    text = cached_demojify(text)
     # Not really tokens
     tokens = text.split()
     for token in tokens:
@@ -26,7 +25,7 @@ def is_caps(text):
 
 
 def has_emoji(text):
-    if text == demojify(text):
+    if text == cached_demojify(text):
         return False
     return True
 
@@ -42,7 +41,7 @@ def has_angry_emoji(text):
              'face_with_raised_eyebrow',
              #'facepalming'
              ]
-    dem = demojify(text, 'en')
+    dem = cached_demojify(text, 'en')
     for a in angry:
         if a in dem:
             return True
@@ -50,7 +49,7 @@ def has_angry_emoji(text):
 
 
 def has_link(text):
-    cleaned = clean_other(text)
+    cleaned = cached_clean_other(text)
     if '[URL]' in cleaned and '[URL]' != cleaned:
         return True
     return False
@@ -78,13 +77,15 @@ def simple_rule(df, out, method):
     method_dict = {'toxic': toxic, 'engaging': engaging, 'fact': fact_claiming}
     with open(out, "w") as pred_file:
         pred_file.write('comment_text\tresult\n')
+        results = {}
         for text in df.text:
-            res = method_dict[method](text)
-            pred_file.write(f'{text}\t{res}\n')
+            if text not in results:
+                results[text] = method_dict[method](text)
+            pred_file.write(f'{text}\t{results[text]}\n')
 
 
 if __name__ == '__main__':
     if len(sys.argv) != 4:
         raise Exception("Use: python3 rules.py [input file] [category: toxic/engaging/fact] [output file]")
     data, _ = read_toxic(sys.argv[1], split=False)
-    simple_rule(pd.concat(data[sys.argv[2].upper()]), sys.argv[3], sys.argv[2])
+    simple_rule(data[sys.argv[2].upper()].to_frame(), sys.argv[3], sys.argv[2])
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+def text_lengths(texts):
+    # Whitespace tokens are a cheap stand-in for the number of word pieces of a text.
+    return np.fromiter((len(str(text).split()) for text in texts), dtype=np.int64, count=len(texts))
+
+
+class EpochSampler:
+    # Produces the batches of an epoch as index arrays. The order only depends on the seed and the epoch,
+    # so an epoch can be replayed exactly.
+    # bucket_size is the number of batches whose examples are sorted by length together, max_tokens caps
+    # the padded size (examples * longest example) of a batch.
+    def __init__(self, batch_size=8, shuffle=True, bucket_size=None, max_tokens=None, seed=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.max_tokens = max_tokens
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+    def cut(self, order, lengths):
+        if self.max_tokens is None or lengths is None:
+            return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batches = []
+        start = 0
+        longest = 0
+        for i, length in enumerate(lengths[order]):
+            longest = max(longest, length)
+            if i > start and ((i - start + 1) * longest > self.max_tokens or i - start == self.batch_size):
+                batches.append(order[start:i])
+                start = i
+                longest = length
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def batches(self, indices, lengths=None, epoch=0):
+        indices = np.asarray(indices)
+        if self.batch_size == 0:
+            return [indices]
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(indices) if self.shuffle else indices
+        if self.bucket_size is None or lengths is None:
+            return self.cut(order, lengths)
+        window = self.bucket_size * self.batch_size
+        batches = []
+        for i in range(0, len(order), window):
+            bucket = order[i:i + window]
+            batches += self.cut(bucket[np.argsort(lengths[bucket], kind='stable')], lengths)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
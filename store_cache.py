@@ -0,0 +1,76 @@
+import hashlib
+import os
+import numpy as np
+import torch
+from sampler import text_lengths
+
+
+def weight_samples(tensor, samples):
+    # Up to samples values of tensor, evenly strided over its elements.
+    flat = tensor.detach().reshape(-1)
+    flat = flat[::max(1, flat.numel() // samples)][:samples]
+    if flat.is_quantized:
+        flat = flat.dequantize()
+    return flat.float().cpu().numpy().tobytes()
+
+
+def store_key(header, texts, state_dict=None, samples=1024):
+    # header describes how the texts are turned into arrays. state_dict holds the weights of the model computing
+    # them, so a retrained or truncated model gets a store of its own. The weights are fingerprinted by their names,
+    # shapes and dtypes and a strided sample of samples values per tensor, instead of hashing all of them.
+    digest = hashlib.sha1()
+    digest.update(header.encode('utf-8'))
+    for name, value in (state_dict or {}).items():
+        # Quantized layers keep their packed weights in tuples.
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not torch.is_tensor(tensor):
+                continue
+            digest.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype}'.encode('utf-8'))
+            digest.update(weight_samples(tensor, samples))
+    for text in texts:
+        digest.update(str(text).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def load_arrays(path, names):
+    return [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names]
+
+
+def build_arrays(path, names, fill):
+    # Loads the .npy files names of path, after writing them with fill unless an earlier build finished.
+    # fill is called with create(name, dtype, shape), which opens a memory-mapped array to write; arrays it
+    # never creates are written empty.
+    if os.path.exists(os.path.join(path, 'done')):
+        return load_arrays(path, names)
+    os.makedirs(path, exist_ok=True)
+    arrays = {}
+
+    def create(name, dtype, shape):
+        arrays[name] = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype,
+                                                 shape=shape)
+        return arrays[name]
+
+    fill(create)
+    for name in names:
+        if name not in arrays:
+            create(name, np.float32, (0, 0))
+    for array in arrays.values():
+        array.flush()
+    arrays.clear()
+    open(os.path.join(path, 'done'), 'w').close()
+    return load_arrays(path, names)
+
+
+def length_sorted_chunks(model, texts, batch_size):
+    # Index chunks of texts sorted by length, for little padding. model is in eval mode and autograd is off
+    # while they are used, so the outputs stored from them carry no dropout.
+    order = np.argsort(text_lengths(texts), kind='stable')
+    training = model.training
+    model.eval()
+    try:
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                yield order[start:start + batch_size]
+    finally:
+        model.train(training)
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import torch
+from store_cache import build_arrays, length_sorted_chunks, load_arrays, store_key
+
+
+TEACHER_CACHE_DIR = '.teacher_cache'
+
+
+def teacher_store_key(texts, teacher):
+    # The texts and a fingerprint of the weights of the teacher.
+    return store_key(f'{type(teacher).__name__}:{getattr(teacher, "max_length", None)}', texts, teacher.state_dict())
+
+
+class TeacherLogits:
+    # Logits of a trained teacher for the training texts, kept in a memory-mapped .npy file. They are computed once
+    # and gathered by the indices of the training batches of every epoch. indices are the sorted indices into the
+    # underlying text array of the rows of logits.
+    def __init__(self, logits, indices):
+        self.logits = logits
+        self.indices = indices
+
+    @classmethod
+    def load(cls, path, indices):
+        return cls(*load_arrays(path, ['logits']), indices)
+
+    @classmethod
+    def build(cls, texts, teacher, indices=None, cache_dir=TEACHER_CACHE_DIR, batch_size=64, device='cpu'):
+        # Only the texts at indices are scored, by default all of them.
+        indices = np.arange(len(texts)) if indices is None else np.unique(indices)
+        texts = texts[indices]
+
+        def fill(create):
+            logits = None
+            for chunk in length_sorted_chunks(teacher, texts, batch_size):
+                chunk_logits = teacher([str(texts[i]) for i in chunk], device=device)[1].float().cpu().numpy()
+                if logits is None:
+                    logits = create('logits', np.float32, (len(texts),) + chunk_logits.shape[1:])
+                logits[chunk] = chunk_logits
+
+        path = os.path.join(cache_dir, teacher_store_key(texts, teacher))
+        return cls(*build_arrays(path, ['logits'], fill), indices)
+
+    def gather(self, indices):
+        return torch.from_numpy(np.ascontiguousarray(self.logits[np.searchsorted(self.indices, indices)]))
@@ -0,0 +1,16 @@
+import numpy as np
+
+
+class TfidfStore:
+    # TF-IDF rows of a whole dataset, transformed once and kept as a sparse CSR matrix.
+    # lengths is the number of features of every row.
+    def __init__(self, matrix):
+        self.matrix = matrix.tocsr()
+        self.lengths = np.diff(self.matrix.indptr)
+
+    @classmethod
+    def build(cls, texts, vectorizer):
+        return cls(vectorizer.transform([str(text) for text in texts]))
+
+    def gather(self, indices):
+        return {'tfidf': self.matrix[indices]}
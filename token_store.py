@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import torch
+from store_cache import build_arrays, load_arrays, store_key
+
+
+TOKEN_CACHE_DIR = '.token_cache'
+
+
+def token_store_key(texts, tokenizer, max_length):
+    return store_key(f'{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}:{max_length}', texts)
+
+
+class TokenStore:
+    # input_ids of a whole dataset, padded to max_length and kept in memory-mapped .npy files.
+    # The attention mask is rebuilt from the stored lengths when a batch is gathered.
+    def __init__(self, input_ids, lengths):
+        self.input_ids = input_ids
+        self.lengths = lengths
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_arrays(path, ['input_ids', 'lengths']))
+
+    @classmethod
+    def build(cls, texts, tokenizer, max_length=None, cache_dir=TOKEN_CACHE_DIR, batch_size=10000):
+        if max_length is None:
+            max_length = min(tokenizer.model_max_length, 512)
+
+        def fill(create):
+            input_ids = create('input_ids', np.int32, (len(texts), max_length))
+            lengths = create('lengths', np.int32, (len(texts),))
+            for start in range(0, len(texts), batch_size):
+                tokenized = tokenizer([str(text) for text in texts[start:start + batch_size]], truncation=True,
+                                      max_length=max_length, padding='max_length', return_tensors='np')
+                input_ids[start:start + batch_size] = tokenized['input_ids']
+                lengths[start:start + batch_size] = tokenized['attention_mask'].sum(axis=1)
+
+        path = os.path.join(cache_dir, token_store_key(texts, tokenizer, max_length))
+        return cls(*build_arrays(path, ['input_ids', 'lengths'], fill))
+
+    def gather(self, indices):
+        lengths = torch.from_numpy(self.lengths[indices].astype(np.int64))
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+        input_ids = torch.from_numpy(self.input_ids[indices, :width].astype(np.int64))
+        attention_mask = (torch.arange(width).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
@@ -1,10 +1,22 @@
 import torch
 from torch import nn
 import copy
-from transformers import BertTokenizer, BertForSequenceClassification, BertForPreTraining, BertModel
-from read_data import read_data, read_bin_data, read_toxic, shuffle
+import time
+from itertools import islice
+from contextlib import ExitStack
+import numpy as np
+from transformers import BertConfig, BertTokenizerFast, BertForSequenceClassification, BertForPreTraining, BertModel
+from read_data import read_data, read_bin_data, read_toxic, shuffle, stream_data, stream_bin_data, stream_toxic
 from metrics import calculate_and_print_metrics
-import pandas as pd
+from sampler import EpochSampler
+from token_store import TokenStore
+from embedding_store import EmbeddingStore
+from tfidf_store import TfidfStore
+from teacher_store import TEACHER_CACHE_DIR, TeacherLogits
+from inference import predict_probabilities, write_probabilities
+from prefetch import prefetch
+from checkpoint import CheckpointManager, rng_state, set_rng_state
+from dataset import TextDataset
 from argparse import ArgumentParser
 from argument_handler import load_config
 from data_preprocessing import compute_class_weights
@@ -16,28 +28,49 @@ SEED = 1234
 torch.manual_seed(SEED)
 
 
+def tokenize(tokenizer, text, max_length=None, device='cpu'):
+    # text is either a list of strings or the already tokenized inputs of a TokenStore.
+    if isinstance(text, dict):
+        tokenized = text
+    else:
+        tokenized = tokenizer(text, truncation=True, max_length=max_length, padding=True, return_tensors="pt")
+    return tokenized['input_ids'].to(device), tokenized['attention_mask'].to(device)
+
+
 class PretrainedClassifier(nn.Module):
-    # https://github.com/huggingface/transformers/issues/2483.
-    def delete_layers(self, num_layers_to_delete):
-        old_module_list = self.bert_model.encoder.layer
-        new_module_list = nn.ModuleList()
-        for i in range(0, len(old_module_list) - num_layers_to_delete):
-            new_module_list.append(old_module_list[i])
-        copy_of_model = copy.deepcopy(self.bert_model)
-        copy_of_model.encoder.layer = new_module_list
-        return copy_of_model
+    def encode(self, text, device='cpu'):
+        # Pooled encoder output. Batches of an EmbeddingStore already hold it.
+        if isinstance(text, dict) and 'pooled_output' in text:
+            return text['pooled_output'].to(device)
+        input_ids, attention_mask = tokenize(self.tokenizer, text, max_length=self.max_length, device=device)
+        return self.bert_model(input_ids, attention_mask=attention_mask)[1]
+
+    @staticmethod
+    def load_encoder(bert_model, num_layers_to_delete=0, pretrained=True):
+        # Builds the encoder without its top num_layers_to_delete layers, so their weights are never loaded.
+        # Without pretrained only the configuration is read; the weights then come from a checkpoint.
+        config = BertConfig.from_pretrained(bert_model)
+        config.num_hidden_layers -= num_layers_to_delete
+        if pretrained:
+            return BertModel.from_pretrained(bert_model, config=config)
+        return BertModel(config)
 
 
 class PretrainedBinary(PretrainedClassifier):
-    def __init__(self, num_class=2, bert_model='bert-base-german-cased', num_layers_to_delete=3, device='cpu', weights=None, freeze=False):
+    max_length = 128
+
+    def __init__(self, num_class=2, bert_model='bert-base-german-cased', num_layers_to_delete=3, device='cpu', weights=None,
+                 freeze=False, pretrained=True):
         super(PretrainedBinary, self).__init__()
+        self.kwargs = {'num_class': num_class, 'bert_model': bert_model, 'num_layers_to_delete': num_layers_to_delete,
+                       'weights': weights, 'freeze': freeze}
         self.num_class = num_class
-        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
-        self.bert_model = BertModel.from_pretrained(bert_model).to(device)
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model)
+        self.bert_model = self.load_encoder(bert_model, num_layers_to_delete, pretrained=pretrained).to(device)
+        self.frozen = freeze
         if freeze:
             for p in self.bert_model.base_model.parameters():
                 p.requires_grad = False
-        self.bert_model = self.delete_layers(num_layers_to_delete=num_layers_to_delete)
         self.lstm = nn.LSTM(768, 256, batch_first=True).to(device)
         self.out = nn.Linear(256, num_class).to(device)
         self.softmax = nn.Softmax(dim=1)
@@ -47,24 +80,68 @@ class PretrainedBinary(PretrainedClassifier):
             self.loss_fct = torch.nn.CrossEntropyLoss()
 
     def forward(self, text, labels=None, device='cpu'):
-        tokenized = self.tokenizer(text, truncation=True, max_length=128, padding=True, return_tensors="pt")
-        input_ids = tokenized['input_ids'].to(device)
-        attention_mask = tokenized['attention_mask'].to(device)
-        embedding = self.bert_model(input_ids, attention_mask=attention_mask)
-        out, hidden = self.lstm(embedding[1].unsqueeze(1))
-        linear_out = self.out(out.squeeze()).view(len(labels), self.num_class)
+        out, hidden = self.lstm(self.encode(text, device=device).unsqueeze(1))
+        linear_out = self.out(out.squeeze(1))
+        if labels is None:
+            return None, linear_out
         return self.loss_fct(linear_out, labels.to(device)), linear_out
 
 
+class MultiTaskBinary(PretrainedClassifier):
+    # One encoder shared by the binary tasks of all categories, with a PretrainedBinary head per category.
+    # The logits are (batch, category, class) and the loss is the sum of the category losses.
+    max_length = 128
+
+    def __init__(self, categories, bert_model='bert-base-german-cased', num_layers_to_delete=3, device='cpu',
+                 weights=None, freeze=False, pretrained=True):
+        super(MultiTaskBinary, self).__init__()
+        self.kwargs = {'categories': categories, 'bert_model': bert_model,
+                       'num_layers_to_delete': num_layers_to_delete, 'weights': weights, 'freeze': freeze}
+        self.categories = list(categories)
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model)
+        self.bert_model = self.load_encoder(bert_model, num_layers_to_delete, pretrained=pretrained).to(device)
+        self.frozen = freeze
+        if freeze:
+            for p in self.bert_model.base_model.parameters():
+                p.requires_grad = False
+        self.lstm = nn.ModuleDict({cat: nn.LSTM(768, 256, batch_first=True) for cat in self.categories}).to(device)
+        self.out = nn.ModuleDict({cat: nn.Linear(256, 2) for cat in self.categories}).to(device)
+        loss_fct = {}
+        for cat in self.categories:
+            if weights is not None and weights.get(cat) is not None:
+                loss_fct[cat] = torch.nn.CrossEntropyLoss(weight=torch.from_numpy(weights[cat]).float())
+            else:
+                loss_fct[cat] = torch.nn.CrossEntropyLoss()
+        self.loss_fct = nn.ModuleDict(loss_fct).to(device)
+
+    def forward(self, text, labels=None, device='cpu'):
+        pooled = self.encode(text, device=device).unsqueeze(1)
+        logits = []
+        for cat in self.categories:
+            out, hidden = self.lstm[cat](pooled)
+            logits.append(self.out[cat](out.squeeze(1)))
+        logits = torch.stack(logits, dim=1)
+        if labels is None:
+            return None, logits
+        labels = labels.to(device)
+        loss = sum(self.loss_fct[cat](logits[:, i], labels[:, i]) for i, cat in enumerate(self.categories))
+        return loss, logits
+
+
 class PretrainedOffense(PretrainedClassifier):
-    def __init__(self, num_class=3, bert_model='bert-base-german-cased', num_layers_to_delete=2, device='cpu', weights=None, freeze=False):
+    max_length = None
+
+    def __init__(self, num_class=3, bert_model='bert-base-german-cased', num_layers_to_delete=2, device='cpu', weights=None,
+                 freeze=False, pretrained=True):
         super(PretrainedOffense, self).__init__()
-        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
-        self.bert_model = BertModel.from_pretrained(bert_model).to(device)
+        self.kwargs = {'num_class': num_class, 'bert_model': bert_model, 'num_layers_to_delete': num_layers_to_delete,
+                       'weights': weights, 'freeze': freeze}
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model)
+        self.bert_model = self.load_encoder(bert_model, num_layers_to_delete, pretrained=pretrained).to(device)
+        self.frozen = freeze
         if freeze:
             for p in self.bert_model.base_model.parameters():
                 p.requires_grad = False
-        self.bert_model = self.delete_layers(num_layers_to_delete=num_layers_to_delete)
         self.out = nn.Linear(768, num_class).to(device)
         self.softmax = nn.Softmax(dim=1)
         if weights is not None:
@@ -73,34 +150,41 @@ class PretrainedOffense(PretrainedClassifier):
             self.loss_fct = torch.nn.CrossEntropyLoss().to(device)
 
     def forward(self, text, labels=None, device='cpu'):
-        tokenized = self.tokenizer(text, truncation=True, padding=True, return_tensors="pt")
-        input_ids = tokenized['input_ids'].to(device)
-        attention_mask = tokenized['attention_mask'].to(device)
-        embedding = self.bert_model(input_ids, attention_mask=attention_mask)
-        linear_out = self.out(embedding[1])
+        linear_out = self.out(self.encode(text, device=device))
         #linear_out = self.softmax(linear_out)
+        if labels is None:
+            return None, linear_out
         return self.loss_fct(linear_out, labels.to(device)), linear_out
 
 
 class BertMasked(nn.Module):
+    max_length = 128
+
     def __init__(self, bert_model='bert-base-german-cased', device='cpu'):
         super(BertMasked, self).__init__()
-        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model)
         self.bert_model = BertForPreTraining.from_pretrained(bert_model).to(device)
 
     def forward(self, text, device='cpu'):
-        tokenized = self.tokenizer(text, truncation=True, max_length=128, padding=True, return_tensors="pt")
-        input_ids = tokenized['input_ids'].to(device)
-        attention_mask = tokenized['attention_mask'].to(device)
+        input_ids, attention_mask = tokenize(self.tokenizer, text, max_length=self.max_length, device=device)
         labels = input_ids
         return self.bert_model(input_ids, attention_mask=attention_mask, labels=labels)
 
 
 class BaseBertModel(nn.Module):
-    def __init__(self, num_class, bert_model='bert-base-german-cased', device='cpu', weights=None, freeze=False):
+    max_length = 128
+
+    def __init__(self, num_class, bert_model='bert-base-german-cased', device='cpu', weights=None, freeze=False,
+                 pretrained=True):
         super(BaseBertModel, self).__init__()
-        self.tokenizer = BertTokenizer.from_pretrained(bert_model)
-        self.bert_model = BertForSequenceClassification.from_pretrained(bert_model, num_labels=num_class).to(device)
+        self.kwargs = {'num_class': num_class, 'bert_model': bert_model, 'weights': weights, 'freeze': freeze}
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model)
+        if pretrained:
+            self.bert_model = BertForSequenceClassification.from_pretrained(bert_model, num_labels=num_class)
+        else:
+            self.bert_model = BertForSequenceClassification(BertConfig.from_pretrained(bert_model, num_labels=num_class))
+        self.bert_model = self.bert_model.to(device)
+        self.frozen = freeze
         if freeze:
             for p in self.bert_model.base_model.parameters():
                 p.requires_grad = False
@@ -109,151 +193,413 @@ class BaseBertModel(nn.Module):
         else:
             self.loss_fct = torch.nn.CrossEntropyLoss()
 
+    def encode(self, text, device='cpu'):
+        # Pooled output of the encoder under the classification head, see PretrainedClassifier.encode.
+        if isinstance(text, dict) and 'pooled_output' in text:
+            return text['pooled_output'].to(device)
+        input_ids, attention_mask = tokenize(self.tokenizer, text, max_length=self.max_length, device=device)
+        return self.bert_model.base_model(input_ids, attention_mask=attention_mask)[1]
+
     def forward(self, text, labels=None, device='cpu'):
-        tokenized = self.tokenizer(text, truncation=True, max_length=128, padding=True, return_tensors="pt")
-        input_ids = tokenized['input_ids'].to(device)
-        attention_mask = tokenized['attention_mask'].to(device)
-        logits = self.bert_model(input_ids, attention_mask=attention_mask, labels=labels.to(device))[1]
+        logits = self.bert_model.classifier(self.bert_model.dropout(self.encode(text, device=device)))
+        if labels is None:
+            return None, logits
         loss = self.loss_fct(logits.view(-1, self.bert_model.num_labels), labels.view(-1).to(device))
         return loss, logits
 
 
 class MachineLearning(nn.Module):
-    def __init__(self, num_class, device='cpu', weights=None, corpus=None):
+    # The TF-IDF rows are fed to the model sparse. Every comment is a single LSTM step from a zero state, which
+    # reduces the LSTM to its input projection and gates: the projection is an EmbeddingBag weighted by the
+    # TF-IDF values, and the forget gate, which has nothing to forget, is left out.
+    hidden_size = 750
+
+    def __init__(self, num_class, device='cpu', weights=None, corpus=None, max_features=10000, vectorizer=None):
+        # vectorizer is an already fitted TfidfVectorizer, used instead of fitting one on corpus.
         super(MachineLearning, self).__init__()
-        self.vectorizer = TfidfVectorizer(max_features=10000, ngram_range=(1, 3))
+        self.vectorizer = TfidfVectorizer(max_features=max_features, ngram_range=(1, 3))
         self.matrix = None
-        if corpus is not None:
+        if vectorizer is not None:
+            self.vectorizer = self.matrix = vectorizer
+        elif corpus is not None:
             self.init_vectorizer(corpus)
-        self.lstm = nn.LSTM(len(self.vectorizer.vocabulary_), 750).to(device)
-        self.out = nn.Linear(750, num_class).to(device)
+        self.kwargs = {'num_class': num_class, 'weights': weights, 'max_features': max_features,
+                       'vectorizer': self.matrix}
+        self.input = nn.EmbeddingBag(len(self.vectorizer.vocabulary_), 3 * self.hidden_size, mode='sum').to(device)
+        self.bias = nn.Parameter(torch.zeros(3 * self.hidden_size, device=device))
+        bound = self.hidden_size ** -0.5
+        nn.init.uniform_(self.input.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+        self.out = nn.Linear(self.hidden_size, num_class).to(device)
         if weights is not None:
             self.loss_fct = torch.nn.CrossEntropyLoss(weight=torch.from_numpy(weights).float().to(device))
         else:
             self.loss_fct = torch.nn.CrossEntropyLoss()
 
+    def __setstate__(self, state):
+        # Models pickled with the dense LSTM input are converted on load. That LSTM read a batch as one sequence
+        # and carried its state from comment to comment; the converted model scores every comment on its own.
+        super(MachineLearning, self).__setstate__(state)
+        if 'lstm' in self._modules:
+            lstm = self._modules.pop('lstm')
+            self.hidden_size = lstm.hidden_size
+            gates = [slice(0, lstm.hidden_size), slice(2 * lstm.hidden_size, 4 * lstm.hidden_size)]
+            weight = torch.cat([lstm.weight_ih_l0[gate] for gate in gates]).detach()
+            bias = lstm.bias_ih_l0 + lstm.bias_hh_l0
+            self.input = nn.EmbeddingBag.from_pretrained(weight.t().contiguous(), freeze=False, mode='sum')
+            self.bias = nn.Parameter(torch.cat([bias[gate] for gate in gates]).detach())
+
     def init_vectorizer(self, corpus):
         self.matrix = self.vectorizer.fit(corpus)
 
     def forward(self, text, labels=None, device='cpu'):
-        x = torch.tensor(self.matrix.transform(text).toarray()).view(len(text), 1, -1).float().to(device)
-        x, _ = self.lstm(x)
-        out = self.out(x.view(len(text), -1))
+        rows = text['tfidf'] if isinstance(text, dict) else self.matrix.transform(text)
+        rows = rows.tocsr()
+        ids = torch.from_numpy(rows.indices.astype(np.int64)).to(device)
+        offsets = torch.from_numpy(rows.indptr[:-1].astype(np.int64)).to(device)
+        values = torch.from_numpy(rows.data.astype(np.float32)).to(device)
+        gates = self.input(ids, offsets, per_sample_weights=values) + self.bias
+        input_gate, cell_gate, output_gate = gates.chunk(3, dim=1)
+        x = torch.sigmoid(output_gate) * torch.tanh(torch.sigmoid(input_gate) * torch.tanh(cell_gate))
+        out = self.out(x)
+        if labels is None:
+            return None, out
         loss = self.loss_fct(out, labels.view(-1).to(device))
         return loss, out
 
 
-def train(model, data, optimizer, label_dict, device='cpu'):
+MODEL_CLASSES = {model_class.__name__: model_class
+                 for model_class in [PretrainedBinary, MultiTaskBinary, PretrainedOffense, BaseBertModel, MachineLearning]}
+
+
+def batch_inputs(batch):
+    return batch.text if batch.inputs is None else batch.inputs
+
+
+def attach_tokens(data, model, token_cache):
+    # Tokenizes the whole dataset once; datasets sharing a text array share the store on disk as well.
+    if data is None or not hasattr(data, 'with_tokens') or not hasattr(model, 'tokenizer'):
+        return data
+    return data.with_tokens(TokenStore.build(data.text, model.tokenizer, max_length=model.max_length,
+                                             cache_dir=token_cache))
+
+
+def is_multi_task(label_dict):
+    # A multi-task label_dict maps every category to the label_dict of its binary task.
+    return all(isinstance(labels, dict) for labels in label_dict.values())
+
+
+def attach_tfidf(data, model):
+    # Transforms the whole dataset once instead of every batch of every epoch.
+    if data is None or not hasattr(data, 'with_tokens'):
+        return data
+    return data.with_tokens(TfidfStore.build(data.text, model.matrix))
+
+
+def attach_embeddings(data, model, embedding_cache, device='cpu'):
+    # Runs the frozen encoder once over the dataset; the model then only runs its head on the stored features.
+    if data is None or not hasattr(data, 'with_tokens'):
+        return data
+    encoder = model.bert_model.base_model if isinstance(model, BaseBertModel) else model.bert_model
+    return data.with_tokens(EmbeddingStore.build(data.text, model, encoder, cache_dir=embedding_cache, device=device))
+
+
+def batch_labels(batch, label_dict):
+    values = batch.binary if len(label_dict) == 2 or is_multi_task(label_dict) else batch.labels
+    return torch.from_numpy(np.asarray(values, dtype=np.int64))
+
+
+def task_metrics(predicted, labels, label_dict):
+    if not is_multi_task(label_dict):
+        return calculate_and_print_metrics([predicted], [labels], label_dict, False)
+    predicted = np.asarray(predicted)
+    labels = np.asarray(labels)
+    matrices = {}
+    stats = {}
+    for i, (cat, cat_labels) in enumerate(label_dict.items()):
+        print(cat)
+        matrices[cat], stats[cat] = calculate_and_print_metrics([predicted[:, i].tolist()], [labels[:, i].tolist()],
+                                                                cat_labels, False)
+    for avg in ['MICRO AVG', 'MACRO AVG']:
+        stats[avg] = {key: np.mean([stats[cat][avg][key] for cat in label_dict])
+                      for key in ['precision', 'recall', 'f1']}
+    return matrices, stats
+
+
+def distillation_loss(loss, logits, teacher_logits, temperature=2.0, alpha=0.5):
+    # alpha weighs the KL divergence from the teacher's probabilities softened by temperature against the loss on
+    # the labels. The divergence is scaled by temperature ** 2 to keep its gradients in the range of the label loss.
+    soft = nn.functional.kl_div(nn.functional.log_softmax(logits / temperature, dim=-1),
+                                nn.functional.log_softmax(teacher_logits / temperature, dim=-1),
+                                reduction='batchmean', log_target=True)
+    return alpha * temperature ** 2 * soft + (1 - alpha) * loss
+
+
+def init_from_teacher(student, teacher):
+    # Copies every weight of the teacher the student has in the same shape: for a student of the teacher's class
+    # with fewer layers these are the lower layers of the encoder, the embeddings and the head. The class weights
+    # of the loss are the student's own.
+    if getattr(teacher, 'quantized', False):
+        return
+    student_state = student.state_dict()
+    copied = {name: tensor for name, tensor in teacher.state_dict().items()
+              if not name.startswith('loss_fct.') and name in student_state
+              and student_state[name].shape == tensor.shape}
+    student.load_state_dict(copied, strict=False)
+    print(f"Initialized {len(copied)} of {len(student_state)} student weights from the teacher")
+
+
+def prepare_batches(model, data, label_dict, prefetch_depth=2, prefetch_workers=1, start=0):
+    # Batch assembly, tokenization and label tensors are done on prefetch threads ahead of the training step.
+    def prepare(item):
+        batch = data.get_batch(item) if isinstance(data, TextDataset) else item
+        inputs = batch_inputs(batch)
+        if not isinstance(inputs, dict) and hasattr(model, 'tokenizer'):
+            input_ids, attention_mask = tokenize(model.tokenizer, inputs, max_length=model.max_length)
+            inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        return batch, inputs, batch_labels(batch, label_dict)
+
+    items = data.batch_indices()[start:] if isinstance(data, TextDataset) else islice(data, start, None)
+    return prefetch(items, prepare, depth=prefetch_depth, workers=prefetch_workers)
+
+
+def optimizer_step(model, optimizer, accumulated, accumulation_steps):
+    # The gradients of the accumulated batches, each scaled by 1 / accumulation_steps, are rescaled to their mean
+    # when the epoch ends before a full accumulation.
+    if accumulated != accumulation_steps:
+        for p in model.parameters():
+            if p.grad is not None:
+                p.grad.mul_(accumulation_steps / accumulated)
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+def train(model, data, optimizer, label_dict, device='cpu', prefetch_depth=2, prefetch_workers=1, start=0,
+          on_step=None, teacher=None, temperature=2.0, alpha=0.5, accumulation_steps=1, precision='fp32'):
+    # Training starts at batch start of the epoch; on_step is called with the number of the batch after each
+    # optimizer step, which is taken every accumulation_steps batches. With precision bf16 the forward passes run
+    # under bfloat16 autocast; the weights, gradients and optimizer state stay fp32.
+    # teacher is a TeacherLogits store over the texts of data; the model is then distilled from it.
     train_loss = 0
     train_acc = 0
+    num_batches = 0
+    num_data = 0
+    num_examples = 0
+    accumulated = 0
     predicted = []
     labels = []
     model.train()
-    for i, batch in enumerate(data):
-        optimizer.zero_grad()
-        if len(label_dict) == 2:
-            label = torch.LongTensor(batch.binary.values.tolist())
-            labels += batch.binary.values.tolist()
-        else:
-            label = torch.LongTensor(batch.labels.values.tolist())
-            labels += batch.labels.values.tolist()
-        text = batch.text.values.tolist()
-        output = model(text, labels=label, device=device)
-        loss = output[0]
+    optimizer.zero_grad()
+    start_time = time.perf_counter()
+    for batch, inputs, label in prepare_batches(model, data, label_dict, prefetch_depth, prefetch_workers, start):
+        num_batches += 1
+        labels += label.tolist()
+        num_data += label.numel()
+        num_examples += len(label)
+        with torch.autocast(device_type=device.split(':')[0], dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            output = model(inputs, labels=label, device=device)
+            loss = output[0]
+            if teacher is not None:
+                loss = distillation_loss(loss, output[1], teacher.gather(batch.indices).to(device),
+                                         temperature=temperature, alpha=alpha)
         train_loss += loss.item()
-        loss.backward()
-        optimizer.step()
-        pred = output[1].argmax(axis=1)
+        (loss / accumulation_steps).backward()
+        accumulated += 1
+        if accumulated == accumulation_steps:
+            optimizer_step(model, optimizer, accumulated, accumulation_steps)
+            accumulated = 0
+            if on_step is not None:
+                on_step(start + num_batches)
+        pred = output[1].argmax(axis=-1)
         train_acc += torch.eq(pred, label.to(device)).sum()
         predicted += pred.tolist()
-    print(f"train loss: {torch.true_divide(train_loss, len(data))} train acc: {torch.true_divide(train_acc, 8 * len(data))}")
-    calculate_and_print_metrics([predicted], [labels], label_dict, False)
+    if accumulated > 0:
+        optimizer_step(model, optimizer, accumulated, accumulation_steps)
+        if on_step is not None:
+            on_step(start + num_batches)
+    seconds = time.perf_counter() - start_time
+    print(f"train loss: {torch.true_divide(train_loss, num_batches)} train acc: {torch.true_divide(train_acc, num_data)}")
+    print(f"train time: {round(seconds, 2)}s {round(num_examples / seconds, 1)} examples/s "
+          f"{round(num_batches / seconds, 2)} batches/s")
+    task_metrics(predicted, labels, label_dict)
+
+
+def print_quantization_drift(stats, quantized_stats, label_dict, seconds, quantized_seconds):
+    # F1 of the fp32 and the int8 model per label, or the macro F1 per category of a multi-task model.
+    if is_multi_task(label_dict):
+        rows = {cat: (stats[cat]['MACRO AVG']['f1'], quantized_stats[cat]['MACRO AVG']['f1']) for cat in label_dict}
+    else:
+        rows = {name: (stat['f1'], quantized_stats[name]['f1']) for name, stat in stats.items()}
+    print("Category\tfp32 F1\tint8 F1\tDrift")
+    for name, (f1, quantized_f1) in rows.items():
+        print(f"{name}\t{round(f1*100, 2)}%\t{round(quantized_f1*100, 2)}%\t{round(float(quantized_f1 - f1)*100, 2)}")
+    print(f"CPU evaluation time fp32: {round(seconds, 2)}s int8: {round(quantized_seconds, 2)}s "
+          f"speedup: {round(seconds / quantized_seconds, 2)}x")
 
 
-def evaluate(model, data, label_dict, device='cpu'):
+def evaluate(model, data, label_dict, device='cpu', prefetch_depth=2, prefetch_workers=1):
     valid_loss = 0
     valid_acc = 0
     predicted = []
     labels = []
     model.eval()
-    batch_len = 0
+    num_batches = 0
     num_data = 0
-    for i, batch in enumerate(data):
-        num_data += len(batch)
-        if len(label_dict) == 2:
-            label = torch.LongTensor(batch.binary.values.tolist())
-            labels += batch.binary.values.tolist()
-        else:
-            label = torch.LongTensor(batch.labels.values.tolist())
-            labels += batch.labels.values.tolist()
-        text = batch.text.values.tolist()
-        output = model(text, labels=label, device=device)
+    for batch, inputs, label in prepare_batches(model, data, label_dict, prefetch_depth, prefetch_workers):
+        num_batches += 1
+        labels += label.tolist()
+        num_data += label.numel()
+        output = model(inputs, labels=label, device=device)
         loss = output[0]
         valid_loss += loss.item()
-        pred = output[1].argmax(axis=1)
+        pred = output[1].argmax(axis=-1)
         valid_acc += torch.eq(pred, label.to(device)).sum()
         predicted += pred.tolist()
-    valid_loss = torch.true_divide(valid_loss, len(data))
+    valid_loss = torch.true_divide(valid_loss, num_batches)
     valid_acc = torch.true_divide(valid_acc, num_data)
     print(f"valid loss: {valid_loss} valid acc: {valid_acc}")
-    return calculate_and_print_metrics([predicted], [labels], label_dict, False), valid_acc, valid_loss
+    return task_metrics(predicted, labels, label_dict), valid_acc, valid_loss
 
 
-def predict(model, data, label_dict, file_path=None, device='cpu'):
+def predict(model, data, label_dict, file_path=None, device='cpu', batch_size=64):
+    # With a multi-task label_dict every category is written to its own file, file_path.format(category).
     predicted = []
-    softmax = nn.Softmax(dim=1)
-    model.eval()
+    tasks = label_dict if is_multi_task(label_dict) else {None: label_dict}
     if file_path is None:
-        file_path = "predictions.tsv"
-    out_file = open(file_path, 'w')
-    labels = '\t'.join([lab for lab in label_dict.values()])
-    out_file.write(f'text\t{labels}\n')
-    for i, batch in enumerate(data):
-        if len(label_dict) == 2:
-            label = torch.LongTensor(batch.binary.values.tolist())
-        else:
-            label = torch.LongTensor(batch.labels.values.tolist())
-        text = batch.text.values.tolist()
-        output = model(text, labels=label, device=device)
-        predicted += output[1].argmax(axis=1).tolist()
-        probs = softmax(output[1])
-        for t, prob in zip(text, probs):
-            prob_str = '\t'.join([str(p) for p in prob.detach().cpu().numpy()])
-            out_file.write(f'{t}\t{prob_str}\n')
-    out_file.close()
+        file_path = "predictions.tsv" if None in tasks else "predictions_{}.tsv"
+    with ExitStack() as stack:
+        out_files = []
+        for cat, task_labels in tasks.items():
+            out_file = stack.enter_context(open(file_path if cat is None else file_path.format(cat), 'w'))
+            labels = '\t'.join([lab for lab in task_labels.values()])
+            out_file.write(f'text\t{labels}\n')
+            out_files.append(out_file)
+        for texts, probs in predict_probabilities(model, data, batch_size=batch_size, device=device):
+            task_probs = probs if probs.ndim == 3 else probs[:, None]
+            for i, out_file in enumerate(out_files):
+                write_probabilities(out_file, texts, task_probs[:, i])
+            predicted += probs.argmax(axis=-1).tolist()
     return predicted
 
 
 def predict_two_models(model_binary, model_classes, data, label_dict, binary_label_dict, device='cpu'):
-    binary = predict(model_binary, data, binary_label_dict, device=device)
-    og_df = pd.concat(data)
-    df = pd.concat(data)
-    df.binary = binary
-    df.labels = [0 for _ in range(len(binary))]
-    df_classes = df[df.binary == 1]
-    classes = [df_classes.iloc[i:i + 8] for i in range(0, len(df_classes), 8)]
-    classes_predicted = predict(model_classes, classes, label_dict, device=device)
-    df_classes.labels = classes_predicted
-    df.update(df_classes)
-    calculate_and_print_metrics([[int(v) for v in df.labels.values.tolist()]], [og_df.labels.values.tolist()],
+    binary = np.array(predict(model_binary, data, binary_label_dict, device=device))
+    classes_predicted = predict(model_classes, data.filter(binary == 1), label_dict, device=device)
+    predicted_labels = np.zeros(len(binary), dtype=np.int64)
+    predicted_labels[binary == 1] = classes_predicted
+    calculate_and_print_metrics([predicted_labels.tolist()], [data.column('labels').tolist()],
                                 {v: k for (k, v) in label_dict.items()}, False)
 
 
-def training_iteration(epochs, model, train_data, valid_data, optimizer, labels, early_stopping, model_path, device='cpu'):
+def checkpoint_state(model, optimizer, data, epoch, batch, step, history):
+    # Everything needed to go on with batch batch of epoch epoch of data. Without a sampler the epoch order is
+    # the shuffled order of the indices, which is stored. Models are stored as a state_dict with the arguments to
+    # rebuild them; models loaded from older pickles without them are pickled whole.
+    sampler = data.sampler
+    state = {'optimizer': optimizer.state_dict(), 'rng': rng_state(), 'step': step, 'history': history,
+             'sampler': {'seed': None if sampler is None else sampler.seed, 'epoch': epoch, 'batch': batch,
+                         'indices': data.indices if sampler is None else None}}
+    if hasattr(model, 'kwargs'):
+        state.update(model_class=type(model).__name__, model_kwargs=model.kwargs, model_state=model.state_dict())
+    else:
+        state['model'] = copy.deepcopy(model)
+    return state
+
+
+def quantize_model(model):
+    # Dynamic int8 quantization of the Linear and LSTM layers of a copy of model. The copy runs on the CPU.
+    model = copy.deepcopy(model).to('cpu')
+    model.eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True)
+    model.quantized = True
+    return model
+
+
+def save_quantized(model, path):
+    if hasattr(model, 'kwargs'):
+        torch.save({'model_class': type(model).__name__, 'model_kwargs': model.kwargs, 'quantized': True,
+                    'model_state': model.state_dict()}, path)
+    else:
+        torch.save({'model': model, 'quantized': True}, path)
+
+
+def load_model_file(path, device='cpu'):
+    # Reads a checkpoint written by training_iteration or save_quantized, or a model pickled whole with torch.save.
+    # Quantized models are always loaded to the CPU.
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    if not isinstance(checkpoint, dict):
+        return checkpoint
+    if 'model' in checkpoint:
+        return checkpoint['model']
+    model_class = MODEL_CLASSES[checkpoint['model_class']]
+    if issubclass(model_class, (PretrainedClassifier, BaseBertModel)):
+        # The encoder is built from its configuration only, the checkpoint holds its weights.
+        model = model_class(device=device, pretrained=False, **checkpoint['model_kwargs'])
+    else:
+        model = model_class(device=device, **checkpoint['model_kwargs'])
+    if checkpoint.get('quantized', False):
+        model = quantize_model(model)
+        model.load_state_dict(checkpoint['model_state'])
+        return model
+    model.load_state_dict(checkpoint['model_state'])
+    return model.to(device)
+
+
+def restore_checkpoint(path, model, optimizer, sampler, device='cpu'):
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    if 'model' in checkpoint:
+        model.load_state_dict(checkpoint['model'].state_dict())
+    else:
+        model.load_state_dict(checkpoint['model_state'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    set_rng_state(checkpoint['rng'])
+    if sampler is not None and checkpoint['sampler']['seed'] is not None:
+        sampler.seed = checkpoint['sampler']['seed']
+    print(f"Resuming from {path} at epoch {checkpoint['sampler']['epoch']}, batch {checkpoint['sampler']['batch']}")
+    return checkpoint
+
+
+def training_iteration(epochs, model, train_data, valid_data, optimizer, labels, early_stopping, device='cpu',
+                       prefetch_depth=2, prefetch_workers=1, checkpoints=None, checkpoint_every=None, resume=None,
+                       teacher=None, temperature=2.0, alpha=0.5, accumulation_steps=1, precision='fp32'):
+    # checkpoints saves a checkpoint after every epoch, scored by the validation macro F1, and every checkpoint_every
+    # optimizer steps. resume is a checkpoint to go on from. teacher, temperature, alpha, accumulation_steps and
+    # precision are passed on to train.
     prev_macro, prev_micro, prev_loss, prev_acc = 0, 0, float('inf'), 0
-    for epoch in range(epochs):
+    start_epoch, start_batch, step = 0, 0, 0
+    if resume is not None:
+        start_epoch, start_batch, step = resume['sampler']['epoch'], resume['sampler']['batch'], resume['step']
+        prev_macro, prev_micro, prev_loss, prev_acc = resume['history']
+    for epoch in range(start_epoch, epochs):
         print(f"\nEpochs: {epoch}/{epochs}")
-        train(model, train_data, optimizer, labels, device=device)
-        (_, stats), acc, loss = evaluate(model, valid_data, labels, device=device)
+        if train_data.sampler is not None:
+            train_data.set_epoch(epoch)
+
+        def on_step(batch):
+            nonlocal step
+            step += 1
+            if checkpoints is not None and checkpoint_every is not None and step % checkpoint_every == 0:
+                checkpoints.save(f'step{step}', checkpoint_state(model, optimizer, train_data, epoch, batch, step,
+                                                                 (prev_macro, prev_micro, prev_loss, prev_acc)))
+
+        train(model, train_data, optimizer, labels, device=device, prefetch_depth=prefetch_depth,
+              prefetch_workers=prefetch_workers, start=start_batch if epoch == start_epoch else 0, on_step=on_step,
+              teacher=teacher, temperature=temperature, alpha=alpha, accumulation_steps=accumulation_steps,
+              precision=precision)
+        (_, stats), acc, loss = evaluate(model, valid_data, labels, device=device, prefetch_depth=prefetch_depth,
+                                         prefetch_workers=prefetch_workers)
         if early_stopping != 'none':
             if (loss > prev_loss and early_stopping == 'loss') or (acc < prev_acc and early_stopping == 'acc') \
                     or (stats['MACRO AVG']['f1'] > prev_macro and early_stopping == 'macro_f1')\
                     or (stats['MICRO AVG']['f1'] > prev_macro and early_stopping == 'macro_f1'):
                 break
             prev_macro, prev_micro, prev_loss, prev_acc = stats['MACRO AVG']['F1'], stats['MICRO AVG']['F1'], loss, acc
-        train_data = shuffle(train_data)
-        if model_path is not None:
-            torch.save(model, f'{model_path}_epoch{epoch}')
+        if train_data.sampler is None:
+            train_data = shuffle(train_data)
+        if checkpoints is not None:
+            checkpoints.save(f'epoch{epoch}', checkpoint_state(model, optimizer, train_data, epoch + 1, 0, step,
+                                                               (prev_macro, prev_micro, prev_loss, prev_acc)),
+                             score=float(stats['MACRO AVG']['f1']))
 
 
 def init_optim(model, optim, weight_decay, lr):
@@ -266,103 +612,260 @@ def init_optim(model, optim, weight_decay, lr):
 
 
 def run_in_mode(train_test, model, train_data, valid_data, optim, lr, epochs, model_path, labels, early_stopping,
-                predict_path, device):
-    if train_test == 'train':
+                predict_path, device, sampler=None, token_cache=None, inference_batch_size=64, prefetch_depth=2,
+                prefetch_workers=1, embedding_cache=None, checkpoint_every=None, keep_last=None, keep_best=None,
+                resume=None, quantize=False, teacher=None, teacher_cache=TEACHER_CACHE_DIR, temperature=2.0,
+                alpha=0.5, accumulation_steps=1, precision='fp32'):
+    # resume is the path of a checkpoint to go on training from, or 'latest' for the latest one of model_path.
+    # With quantize, test and predict use a dynamic int8 copy of the model, saved to <model_path>_int8. Testing
+    # evaluates both models and reports the difference in F1.
+    # distill trains model like train, on the logits of the trained teacher cached under teacher_cache as well.
+    if getattr(model, 'quantized', False):
+        device = 'cpu'
+    if embedding_cache is not None:
+        if not getattr(model, 'frozen', False) or not hasattr(model, 'encode'):
+            raise Exception("The embedding cache needs a Pretrained or BaseBertModel model with a frozen encoder!")
+        train_data = attach_embeddings(train_data, model, embedding_cache, device=device)
+        valid_data = attach_embeddings(valid_data, model, embedding_cache, device=device)
+    elif isinstance(model, MachineLearning):
+        train_data = attach_tfidf(train_data, model)
+        valid_data = attach_tfidf(valid_data, model)
+    elif token_cache is not None:
+        train_data = attach_tokens(train_data, model, token_cache)
+        valid_data = attach_tokens(valid_data, model, token_cache)
+    if train_test in ['train', 'distill']:
+        teacher_logits = None
+        if train_test == 'distill':
+            if teacher is None:
+                raise Exception("Distillation needs a teacher model!")
+            teacher_device = 'cpu' if getattr(teacher, 'quantized', False) else device
+            teacher_logits = TeacherLogits.build(train_data.text, teacher, indices=train_data.indices,
+                                                 cache_dir=teacher_cache, batch_size=inference_batch_size,
+                                                 device=teacher_device)
+            if resume is None:
+                init_from_teacher(model, teacher)
+        if sampler is not None:
+            train_data = train_data.with_sampler(sampler)
         optimizer = init_optim(model, optim, 1e-5, lr)
-        training_iteration(epochs, model, train_data, valid_data, optimizer, labels, early_stopping,
-                           model_path=model_path, device=device)
+        checkpoints = None
+        if model_path is not None:
+            checkpoints = CheckpointManager(model_path, keep_last=keep_last, keep_best=keep_best,
+                                            resume=resume is not None)
+        checkpoint = None
+        if resume == 'latest':
+            if checkpoints is None:
+                raise Exception("Resuming from the latest checkpoint needs a model path!")
+            resume = checkpoints.latest()
+        if resume is not None:
+            checkpoint = restore_checkpoint(resume, model, optimizer, train_data.sampler, device=device)
+            if checkpoint['sampler'].get('indices') is not None:
+                train_data = train_data.view(checkpoint['sampler']['indices'])
+        try:
+            training_iteration(epochs, model, train_data, valid_data, optimizer, labels, early_stopping,
+                               device=device, prefetch_depth=prefetch_depth, prefetch_workers=prefetch_workers,
+                               checkpoints=checkpoints, checkpoint_every=checkpoint_every, resume=checkpoint,
+                               teacher=teacher_logits, temperature=temperature, alpha=alpha,
+                               accumulation_steps=accumulation_steps, precision=precision)
+        finally:
+            if checkpoints is not None:
+                checkpoints.close()
+    elif train_test == 'test' and quantize:
+        # Both models are timed on the CPU, where the int8 model runs.
+        baseline = model if device == 'cpu' else copy.deepcopy(model).to('cpu')
+        start = time.perf_counter()
+        (_, stats), _, _ = evaluate(baseline, valid_data, labels, device='cpu', prefetch_depth=prefetch_depth,
+                                    prefetch_workers=prefetch_workers)
+        seconds = time.perf_counter() - start
+        quantized = quantize_model(model)
+        if model_path is not None:
+            save_quantized(quantized, f'{model_path}_int8')
+        start = time.perf_counter()
+        (_, quantized_stats), _, _ = evaluate(quantized, valid_data, labels, device='cpu',
+                                              prefetch_depth=prefetch_depth, prefetch_workers=prefetch_workers)
+        print_quantization_drift(stats, quantized_stats, labels, seconds, time.perf_counter() - start)
     elif train_test == 'test':
-        evaluate(model, valid_data, labels, device=device)
+        evaluate(model, valid_data, labels, device=device, prefetch_depth=prefetch_depth,
+                 prefetch_workers=prefetch_workers)
     elif train_test == 'predict':
-        predict(model, valid_data, labels, file_path=predict_path, device=device)
+        if quantize:
+            model = quantize_model(model)
+            device = 'cpu'
+            if model_path is not None:
+                save_quantized(model, f'{model_path}_int8')
+        predict(model, valid_data, labels, file_path=predict_path, device=device, batch_size=inference_batch_size)
 
 
 def binary_models(train_test, data, data_type, batch_size, epochs, device, model_type, load_model, model_path, optim,
                   lr, bert_model, num_layers_to_delete, weight_method, early_stopping, predict_path, need_other,
-                  pretrained_path):
+                  pretrained_path, chunk_size=None, preprocess=None, sampler=None, token_cache=None,
+                  inference_batch_size=64, prefetch_depth=2, prefetch_workers=1, multi_task=False, freeze=False,
+                  embedding_cache=None, max_features=10000, checkpoint_every=None, keep_last=None, keep_best=None,
+                  resume=None, quantize=False, teacher_path=None, teacher_cache=TEACHER_CACHE_DIR, temperature=2.0,
+                  alpha=0.5, accumulation_steps=1, precision='fp32', near_duplicate_threshold=None):
+    # With multi_task all categories are trained as one MultiTaskBinary model, stored under the name ALL.
+    # The teachers of distill are read from teacher_path.format(name), an explicit resume checkpoint from
+    # resume.format(name).
     if data_type == 'twitter':
-        train_data, valid = read_bin_data(data, batch_size, need_other=need_other, all_data=True)
-        models = {'ABUSE': None, 'INSULT': None, 'PROFANITY': None}
+        categories = ['ABUSE', 'INSULT', 'PROFANITY']
     else:
-        train_data, valid = read_toxic(data, batch_size)
-        models = {'TOXIC': None, 'ENGAGING': None, 'FACT': None}
-    if load_model or train_test != 'train':
+        categories = ['TOXIC', 'ENGAGING', 'FACT']
+    if chunk_size is not None and train_test in ['test', 'predict']:
+        path = data if isinstance(data, str) else data[-1]
+        train_data = None
+        if data_type == 'twitter':
+            valid = stream_bin_data(path, batch_size, chunk_size, need_other=need_other, multi_label=multi_task,
+                                    preprocess=preprocess)
+        else:
+            valid = stream_toxic(path, batch_size, chunk_size, multi_label=multi_task, preprocess=preprocess)
+    elif data_type == 'twitter':
+        train_data, valid = read_bin_data(data, batch_size, need_other=need_other, all_data=True,
+                                          preprocess=preprocess, seed=SEED, multi_label=multi_task,
+                                          near_duplicate_threshold=near_duplicate_threshold)
+    else:
+        train_data, valid = read_toxic(data, batch_size, preprocess=preprocess, multi_label=multi_task,
+                                       near_duplicate_threshold=near_duplicate_threshold)
+    if multi_task:
+        tasks = {'ALL': {cat: {0: 'OTHER', 1: cat} for cat in categories}}
+        train_data = None if train_data is None else {'ALL': train_data}
+        valid = {'ALL': valid}
+    else:
+        tasks = {cat: {0: 'OTHER', 1: cat} for cat in categories}
+    models = {name: None for name in tasks}
+    teachers = {name: None for name in tasks}
+    if train_test == 'distill':
+        if teacher_path is None:
+            raise Exception("No teacher path given!")
+        teachers = {name: load_model_file(teacher_path.format(name), device=device) for name in tasks}
+    if load_model or train_test not in ['train', 'distill']:
         if pretrained_path is not None:
-            models = {cat: torch.load(pretrained_path.format(cat)) for cat in models}
+            models = {name: load_model_file(pretrained_path.format(name), device=device) for name in models}
         elif model_path is not None:
-            models = {cat: torch.load(model_path.format(cat)) for cat in models}
+            models = {name: load_model_file(model_path.format(name), device=device) for name in models}
     else:
         if model_type is None:
             raise Exception("No model type given!")
+        if multi_task and model_type != 'Pretrained':
+            raise Exception("Multi-task training is only available for the Pretrained model type!")
         for cat in models:
-            weights = compute_class_weights(pd.concat(train_data[cat]).binary, weight_method)
+            if multi_task:
+                weights = {task: compute_class_weights(train_data[cat].category(task).column('binary'), weight_method)
+                           for task in categories}
+                models[cat] = MultiTaskBinary(categories, bert_model=bert_model, weights=weights,
+                                              num_layers_to_delete=num_layers_to_delete, device=device,
+                                              freeze=freeze)
+                continue
+            weights = compute_class_weights(train_data[cat].column('binary'), weight_method)
             if model_type == "BaseBertModel":
-                models[cat] = BaseBertModel(num_class=2, weights=weights, bert_model=bert_model, device=device)
+                models[cat] = BaseBertModel(num_class=2, weights=weights, bert_model=bert_model, device=device,
+                                            freeze=freeze)
             elif model_type == "MachineLearning":
-                models[cat] = MachineLearning(num_class=2, corpus=pd.concat(train_data[cat]).text.tolist(),
-                                              weights=weights, device=device)
+                models[cat] = MachineLearning(num_class=2, corpus=train_data[cat].texts(),
+                                              weights=weights, device=device, max_features=max_features)
             else:
                 models[cat] = PretrainedBinary(bert_model=bert_model, weights=weights,
-                                               num_layers_to_delete=num_layers_to_delete, device=device)
+                                               num_layers_to_delete=num_layers_to_delete, device=device,
+                                               freeze=freeze)
     for cat in models:
-        labels = {0: 'OTHER', 1: cat}
+        labels = tasks[cat]
         if predict_path is None:
             pp = None
+        elif multi_task:
+            pp = predict_path
         else:
             pp = predict_path.format(cat)
-        run_in_mode(train_test, models[cat], train_data[cat], valid[cat], optim, lr, epochs, model_path.format(cat),
-                    labels, early_stopping, pp, device)
+        cat_train = None if train_data is None else train_data[cat]
+        cat_resume = resume if resume in [None, 'latest'] else resume.format(cat)
+        run_in_mode(train_test, models[cat], cat_train, valid[cat], optim, lr, epochs, model_path.format(cat),
+                    labels, early_stopping, pp, device, sampler=sampler, token_cache=token_cache,
+                    inference_batch_size=inference_batch_size, prefetch_depth=prefetch_depth,
+                    prefetch_workers=prefetch_workers, embedding_cache=embedding_cache,
+                    checkpoint_every=checkpoint_every, keep_last=keep_last, keep_best=keep_best, resume=cat_resume,
+                    quantize=quantize, teacher=teachers[cat], teacher_cache=teacher_cache, temperature=temperature,
+                    alpha=alpha, accumulation_steps=accumulation_steps, precision=precision)
 
 
 def main(train_test, mode, data, data_type, batch_size, epochs, device, model_type, load_model,
          model_path, model_path2, optim, lr, bert_model, num_layers_to_delete, weight_method,
-         early_stopping, predict_path, need_other, pretrained_path):
+         early_stopping, predict_path, need_other, pretrained_path, chunk_size=None, preprocess=None,
+         near_duplicate_threshold=None, bucket_size=None, max_tokens=None, token_cache=None,
+         inference_batch_size=64, prefetch_depth=2, prefetch_workers=1, multi_task=False, freeze=False,
+         embedding_cache=None, max_features=10000, checkpoint_every=None, keep_last=None, keep_best=None,
+         resume=None, quantize=False, teacher_path=None, teacher_cache=TEACHER_CACHE_DIR, temperature=2.0,
+         alpha=0.5, accumulation_steps=1, precision='fp32'):
+    if accumulation_steps < 1:
+        raise Exception("The number of accumulation steps has to be at least 1!")
+    # Without bucketing or a token budget the training data is reshuffled after every epoch instead.
+    sampler = None
+    if bucket_size is not None or max_tokens is not None:
+        sampler = EpochSampler(batch_size, bucket_size=bucket_size, max_tokens=max_tokens, seed=SEED)
     if mode == 'binary_categories':
         binary_models(train_test, data, data_type, batch_size, epochs, device, model_type, load_model, model_path,
                       optim, lr, bert_model, num_layers_to_delete, weight_method, early_stopping, predict_path,
-                      need_other, pretrained_path)
+                      need_other, pretrained_path, chunk_size=chunk_size, preprocess=preprocess, sampler=sampler,
+                      token_cache=token_cache, inference_batch_size=inference_batch_size,
+                      prefetch_depth=prefetch_depth, prefetch_workers=prefetch_workers, multi_task=multi_task,
+                      freeze=freeze, embedding_cache=embedding_cache, max_features=max_features,
+                      checkpoint_every=checkpoint_every, keep_last=keep_last, keep_best=keep_best, resume=resume,
+                      quantize=quantize, teacher_path=teacher_path, teacher_cache=teacher_cache,
+                      temperature=temperature, alpha=alpha, accumulation_steps=accumulation_steps,
+                      precision=precision, near_duplicate_threshold=near_duplicate_threshold)
     else:
         drop = (mode == 'offense')
-        train_data, valid, label_dict, binary_label_dict = read_data(data, batch_size=batch_size, drop_other=drop)
+        if chunk_size is not None and train_test in ['test', 'predict']:
+            train_data = None
+            valid, label_dict, binary_label_dict = stream_data(data if isinstance(data, str) else data[-1],
+                                                               batch_size=batch_size, chunk_size=chunk_size,
+                                                               drop_other=drop, preprocess=preprocess)
+        else:
+            train_data, valid, label_dict, binary_label_dict = read_data(
+                data, batch_size=batch_size, drop_other=drop, preprocess=preprocess,
+                near_duplicate_threshold=near_duplicate_threshold)
 
         if mode == 'binary':
             labels = {v: k for (k, v) in binary_label_dict.items()}
-            weights = compute_class_weights(pd.concat(train_data).binary, weight_method)
         else:
             labels = {v: k for (k, v) in label_dict.items()}
-            weights = compute_class_weights(pd.concat(train_data).labels, weight_method)
 
-        if load_model or train_test != "train":
+        teacher = None
+        if train_test == 'distill':
+            if teacher_path is None:
+                raise Exception("No teacher path given!")
+            teacher = load_model_file(teacher_path, device=device)
+        if load_model or train_test not in ["train", "distill"]:
             if pretrained_path is not None:
-                model = torch.load(pretrained_path)
+                model = load_model_file(pretrained_path, device=device)
             elif model_path is not None:
-                model = torch.load(model_path)
+                model = load_model_file(model_path, device=device)
             elif model_path2 is not None:
-                model = torch.load(model_path2)
+                model = load_model_file(model_path2, device=device)
             else:
                 raise Exception("No model path given!")
             if model_path is not None and model_path2 is not None:
-                model2 = torch.load(model_path2)
+                model2 = load_model_file(model_path2, device=device)
         else:
             if model_type is None:
                 raise Exception("No model type given!")
+            if mode == 'binary':
+                weights = compute_class_weights(train_data.column('binary'), weight_method)
+            else:
+                weights = compute_class_weights(train_data.column('labels'), weight_method)
             class_count = {'all': 4, 'offense': 3, 'binary': 2}
             if model_type == "BaseBertModel":
                 model = BaseBertModel(num_class=class_count[mode], bert_model=bert_model,
-                                      weights=weights, device=device)
+                                      weights=weights, device=device, freeze=freeze)
             elif model_type == "MachineLearning":
-                model = MachineLearning(num_class=class_count[mode], corpus=pd.concat(train_data).text.tolist(),
-                                        weights=weights, device=device)
+                model = MachineLearning(num_class=class_count[mode], corpus=train_data.texts(),
+                                        weights=weights, device=device, max_features=max_features)
             else:
                 if mode == 'offense':
                     model = PretrainedOffense(bert_model=bert_model, num_layers_to_delete=num_layers_to_delete,
-                                              device=device)
+                                              device=device, freeze=freeze)
                 elif mode == 'binary':
                     model = PretrainedBinary(bert_model=bert_model, num_layers_to_delete=num_layers_to_delete,
-                                             device=device)
+                                             device=device, freeze=freeze)
                 else:
                     model = PretrainedBinary(num_class=4, bert_model=bert_model,
-                                             num_layers_to_delete=num_layers_to_delete, device=device)
+                                             num_layers_to_delete=num_layers_to_delete, device=device, freeze=freeze)
 
         if train_test == 'test2':
             try:
@@ -371,13 +874,18 @@ def main(train_test, mode, data, data_type, batch_size, epochs, device, model_ty
                 raise Exception("No second model path given")
         else:
             run_in_mode(train_test, model, train_data, valid, optim, lr, epochs, model_path, labels, early_stopping,
-                        predict_path, device)
+                        predict_path, device, sampler=sampler, token_cache=token_cache,
+                        inference_batch_size=inference_batch_size, prefetch_depth=prefetch_depth,
+                        prefetch_workers=prefetch_workers, embedding_cache=embedding_cache,
+                        checkpoint_every=checkpoint_every, keep_last=keep_last, keep_best=keep_best, resume=resume,
+                        quantize=quantize, teacher=teacher, teacher_cache=teacher_cache, temperature=temperature,
+                        alpha=alpha, accumulation_steps=accumulation_steps, precision=precision)
 
 
 if __name__ == "__main__":
     argparser = ArgumentParser()
     argparser.add_argument('--config', '-c')
-    argparser.add_argument('--train_test', choices=['train', 'test', 'test2', 'predict'], default='train')
+    argparser.add_argument('--train_test', choices=['train', 'test', 'test2', 'predict', 'distill'], default='train')
     argparser.add_argument('--pretrained_path')
     argparser.add_argument('--mode', choices=['binary', 'offense', 'all', 'binary_categories'], default='all')
     argparser.add_argument('--batch_size', type=int, default=8)
@@ -396,6 +904,75 @@ if __name__ == "__main__":
     argparser.add_argument('--early_stopping', choices=['macro_f1', 'acc', 'micro_f1', 'loss', 'none'], default='none')
     argparser.add_argument('--predict_path', default=None)
     argparser.add_argument('--need_other', action='store_true')
+    argparser.add_argument('--chunk_size', type=int, default=None,
+                           help='Stream the evaluated file in chunks of this many rows when testing or predicting. '
+                                'The last data path is streamed as a whole.')
+    argparser.add_argument('--preprocess', choices=['facebook', 'twitter'], default=None,
+                           help='Clean the texts with the given mode before use. '
+                                'Cleaned datasets are cached and reused while the source file is unchanged.')
+    argparser.add_argument('--near_duplicate_threshold', type=float, default=None,
+                           help='When splitting a single data file, keep texts with at least this estimated '
+                                'Jaccard similarity on the same side of the train/valid split.')
+    argparser.add_argument('--bucket_size', type=int, default=None,
+                           help='Sort the training examples by length within windows of this many batches, '
+                                'so that batches hold texts of similar length.')
+    argparser.add_argument('--max_tokens', type=int, default=None,
+                           help='Upper bound on the padded size (examples * longest text) of a training batch.')
+    argparser.add_argument('--token_cache', default=None,
+                           help='Tokenize the datasets once into memory-mapped arrays under this directory '
+                                'and feed the models pre-tokenized batches.')
+    argparser.add_argument('--inference_batch_size', type=int, default=64,
+                           help='Batch size used when predicting. Texts are sorted by length within a window of '
+                                'batches and written back in their original order.')
+    argparser.add_argument('--prefetch_depth', type=int, default=2,
+                           help='Number of batches prepared (tokenized, labels built) ahead of the training step. '
+                                '0 prepares every batch in the loop itself.')
+    argparser.add_argument('--prefetch_workers', type=int, default=1,
+                           help='Number of threads preparing batches ahead of the training step.')
+    argparser.add_argument('--multi_task', action='store_true',
+                           help='In binary_categories mode, train one model with a shared encoder and a head per '
+                                'category instead of a model per category. It is saved and loaded with the category '
+                                'name ALL, predictions are still written per category.')
+    argparser.add_argument('--freeze', action='store_true',
+                           help='Freeze the encoder of the model and only train its head.')
+    argparser.add_argument('--embedding_cache', default=None,
+                           help='With a frozen encoder, encode the datasets once into memory-mapped arrays under this '
+                                'directory and run only the model heads on the stored features.')
+    argparser.add_argument('--max_features', type=int, default=10000,
+                           help='Size of the TF-IDF vocabulary of the MachineLearning model.')
+    argparser.add_argument('--checkpoint_every', type=int, default=None,
+                           help='Besides after every epoch, save a checkpoint every this many training steps.')
+    argparser.add_argument('--keep_last', type=int, default=None,
+                           help='Keep only this many of the latest checkpoints (all by default).')
+    argparser.add_argument('--keep_best', type=int, default=None,
+                           help='With --keep_last, also keep this many epoch checkpoints with the best validation '
+                                'macro F1.')
+    argparser.add_argument('--resume', nargs='?', const='latest', default=None,
+                           help='Go on training from the given checkpoint, or from the latest checkpoint of the model '
+                                'path. Use the arguments of the interrupted run. In binary_categories mode a '
+                                'given checkpoint is a {}-pattern of the checkpoints per category.')
+    argparser.add_argument('--quantize', action='store_true',
+                           help='Test or predict with a dynamic int8 quantized copy of the model, which runs on the CPU '
+                                'and is saved next to the model as <model_path>_int8. Testing also evaluates the '
+                                'original model and prints the change in F1.')
+    argparser.add_argument('--teacher_path', default=None,
+                           help='With --train_test distill, the trained model (or {}-pattern of models per category) '
+                                'whose logits the new model is trained on besides the labels. Weights the new model '
+                                'shares with it in shape, such as the lower encoder layers of a -d student, are copied.')
+    argparser.add_argument('--teacher_cache', default=TEACHER_CACHE_DIR,
+                           help='Directory the teacher logits of the training data are computed into once.')
+    argparser.add_argument('--temperature', type=float, default=2.0,
+                           help='Temperature softening the teacher and student probabilities when distilling.')
+    argparser.add_argument('--distill_alpha', type=float, default=0.5,
+                           help='Weight of the loss on the teacher probabilities against the loss on the labels.')
+    argparser.add_argument('--accumulation_steps', type=int, default=1,
+                           help='Accumulate the gradients of this many batches into one optimizer step, for an '
+                                'effective batch size of batch_size * accumulation_steps. Checkpoint steps count '
+                                'optimizer steps.')
+    argparser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+                           help='Run the training forward passes under bfloat16 autocast. The weights and the '
+                                'optimizer stay fp32, validation and prediction are unchanged. Only faster on CPUs '
+                                'with native bfloat16 support (AVX512-BF16 or AMX).')
     args = argparser.parse_args()
     if torch.cuda.is_available():
         dev = "cuda:0"
@@ -409,4 +986,13 @@ if __name__ == "__main__":
          load_model=args.load_model, model_path=args.model_path, model_path2=args.model_path2, optim=args.optimizer,
          lr=args.learning_rate, bert_model=args.bert_model, num_layers_to_delete=args.num_layers_to_delete,
          weight_method=args.weight_method, early_stopping=args.early_stopping, predict_path=args.predict_path,
-         need_other=args.need_other, pretrained_path=args.pretrained_path)
+         need_other=args.need_other, pretrained_path=args.pretrained_path, chunk_size=args.chunk_size,
+         preprocess=args.preprocess, near_duplicate_threshold=args.near_duplicate_threshold,
+         bucket_size=args.bucket_size, max_tokens=args.max_tokens, token_cache=args.token_cache,
+         inference_batch_size=args.inference_batch_size, prefetch_depth=args.prefetch_depth,
+         prefetch_workers=args.prefetch_workers, multi_task=args.multi_task, freeze=args.freeze,
+         embedding_cache=args.embedding_cache, max_features=args.max_features,
+         checkpoint_every=args.checkpoint_every, keep_last=args.keep_last, keep_best=args.keep_best,
+         resume=args.resume, quantize=args.quantize, teacher_path=args.teacher_path,
+         teacher_cache=args.teacher_cache, temperature=args.temperature, alpha=args.distill_alpha,
+         accumulation_steps=args.accumulation_steps, precision=args.precision)